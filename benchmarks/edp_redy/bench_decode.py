@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the decoding of GetSwitchModules responses.
+
+Compares, per update cycle, the CPU time of the previous pipeline (decode
+the body to text, build the debug message, json.loads and keep the raw
+modules) with the current one (parse the bytes, extract Body.Modules and
+build the module records, lazy debug logging).
+
+    python bench_decode.py --modules 10 100 1000
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COMPONENT = os.path.join(HERE, '..', '..', 'edp_redy', 'edp_redy.py')
+
+sys.path.insert(0, HERE)
+from fake_portal import FakePortal  # noqa: E402
+
+
+def load_component():
+    """Import the edp_redy component from the repository."""
+    spec = importlib.util.spec_from_file_location('edp_redy', COMPONENT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_body(modules):
+    """Return a GetSwitchModules response body for a number of modules."""
+    portal = FakePortal(modules=modules, seed=1)
+    portal._step_power()
+    return json.dumps({'Body': {'Modules': portal._modules}}).encode()
+
+
+def decode_before(body):
+    """Decode a response like the component used to."""
+    modules_str = body.decode('utf-8')
+    "Fetched Modules:\n" + modules_str
+    updated_dict = json.loads(modules_str)
+    modules_dict = {}
+    for module in updated_dict["Body"]["Modules"]:
+        modules_dict[module['PKID']] = module
+    return modules_dict
+
+
+def decode_after(component, body):
+    """Decode a response like the component does now."""
+    component._log_body("Fetched Modules:\n%s", body)
+    modules_dict = {}
+    for module_json in component._decode_body_field(body, "Modules"):
+        module = component.EdpRedyModule.from_json(module_json)
+        modules_dict[module.pkid] = module
+    return modules_dict
+
+
+def bench(function, number):
+    """Return the best time per call in milliseconds."""
+    timer = timeit.Timer(function)
+    return min(timer.repeat(repeat=5, number=number)) / number * 1000
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--modules', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    component = load_component()
+    backend = getattr(component.json_loads, '__module__', None) or 'orjson'
+    print('json backend: {0}'.format(backend))
+
+    row = '{0:>8} {1:>12} {2:>12} {3:>12} {4:>9}'
+    print(row.format('modules', 'body_kib', 'before_ms', 'after_ms',
+                     'speedup'))
+    for modules in args.modules:
+        body = make_body(modules)
+        number = max(1, 2000 // modules)
+        before = bench(lambda: decode_before(body), number)
+        after = bench(lambda: decode_after(component, body), number)
+        print(row.format(modules, '{0:.1f}'.format(len(body) / 1024),
+                         '{0:.3f}'.format(before), '{0:.3f}'.format(after),
+                         '{0:.2f}x'.format(before / after)))
+
+
+if __name__ == '__main__':
+    main()
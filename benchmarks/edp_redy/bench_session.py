@@ -0,0 +1,196 @@
+"""
+Benchmark EdpRedySession against the offline portal.
+
+For each module count, starts fake_portal.py in a separate process (so its
+work is not measured) and runs update cycles of a session against it,
+reporting:
+
+- requests per cycle, as counted by the portal
+- logins per hour, assuming a cycle every UPDATE_INTERVAL seconds and
+  portal sessions lasting --session-minutes
+- wall clock latency of async_update (mean and p95)
+- CPU time and peak allocated memory per cycle
+
+    python bench_session.py --modules 10 100 1000 --cycles 50 --latency 0.2
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import socket
+import statistics
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+
+from homeassistant.core import HomeAssistant
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_PORTAL = os.path.join(HERE, 'fake_portal.py')
+COMPONENT = os.path.join(HERE, '..', '..', 'edp_redy', 'edp_redy.py')
+
+
+def load_component():
+    """Import the edp_redy component from the repository."""
+    spec = importlib.util.spec_from_file_location('edp_redy', COMPONENT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port():
+    """Return a free TCP port on localhost."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    """Return the given percentile of values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def async_start_portal(port, modules, args, requests_per_cycle):
+    """Start the portal process and wait until it answers."""
+    max_requests = int(args.session_minutes * 60 / args.interval *
+                       requests_per_cycle)
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, FAKE_PORTAL, '--port', str(port),
+        '--modules', str(modules), '--latency', str(args.latency),
+        '--error-rate', str(args.error_rate),
+        '--session-max-requests', str(max_requests), '--seed', '1',
+        stdout=asyncio.subprocess.DEVNULL)
+
+    async with aiohttp.ClientSession() as client:
+        for _ in range(100):
+            try:
+                async with client.get(
+                        'http://127.0.0.1:{0}/_stats'.format(port)):
+                    return process
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError('fake portal did not start')
+
+
+async def async_portal_call(port, method, path):
+    """Call one of the portal's control endpoints."""
+    async with aiohttp.ClientSession() as client:
+        async with client.request(
+                method, 'http://127.0.0.1:{0}{1}'.format(port, path)) as resp:
+            return await resp.json()
+
+
+async def async_bench(hass, component, modules, args):
+    """Benchmark update cycles for a number of modules."""
+    port = free_port()
+    process = await async_start_portal(port, modules, args, 2)
+    try:
+        session = component.EdpRedySession(
+            hass, 'bench', 'bench',
+            url_base='http://127.0.0.1:{0}/EdpPortal/'.format(port))
+
+        # first cycle logs in and fills the module records
+        await session.async_update()
+        await async_portal_call(port, 'POST', '/_reset')
+
+        walls = []
+        cpus = []
+        failures = 0
+        for _ in range(args.cycles):
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            if not await session.async_update():
+                failures += 1
+            cpus.append(time.process_time() - cpu)
+            walls.append(time.perf_counter() - wall)
+
+        stats = await async_portal_call(port, 'GET', '/_stats')
+
+        # allocations are measured apart, tracemalloc skews the timings
+        tracemalloc.start()
+        peaks = []
+        for _ in range(min(args.cycles, 10)):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            await session.async_update()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+
+        await session.async_logout()
+    finally:
+        process.terminate()
+        await process.wait()
+
+    hours = args.cycles * args.interval / 3600
+    return {
+        'modules': modules,
+        'cycles': args.cycles,
+        'failures': failures,
+        'requests_per_cycle': stats['total_requests'] / args.cycles,
+        'logins_per_hour': stats['logins'] / hours,
+        'wall_mean_ms': statistics.mean(walls) * 1000,
+        'wall_p95_ms': percentile(walls, 0.95) * 1000,
+        'cpu_mean_ms': statistics.mean(cpus) * 1000,
+        'peak_alloc_kib': statistics.mean(peaks) / 1024,
+    }
+
+
+async def async_main(hass, args):
+    """Run the benchmark for all module counts."""
+    component = load_component()
+    results = []
+    for modules in args.modules:
+        results.append(await async_bench(hass, component, modules, args))
+    return results
+
+
+def print_results(results):
+    """Print the results as a table."""
+    columns = ['modules', 'cycles', 'failures', 'requests_per_cycle',
+               'logins_per_hour', 'wall_mean_ms', 'wall_p95_ms',
+               'cpu_mean_ms', 'peak_alloc_kib']
+    print(' '.join('{0:>18}'.format(column) for column in columns))
+    for result in results:
+        print(' '.join(
+            '{0:>18.2f}'.format(result[column])
+            if isinstance(result[column], float)
+            else '{0:>18}'.format(result[column]) for column in columns))
+
+
+def main():
+    """Parse the arguments and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--modules', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--cycles', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the portal takes per response')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--interval', type=float, default=30,
+                        help='seconds between cycles in production')
+    parser.add_argument('--session-minutes', type=float, default=20,
+                        help='how long a portal session lasts')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as json')
+    args = parser.parse_args()
+
+    hass = HomeAssistant()
+    try:
+        results = hass.loop.run_until_complete(async_main(hass, args))
+    finally:
+        hass.loop.run_until_complete(hass.async_stop())
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
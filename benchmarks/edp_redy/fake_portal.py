@@ -0,0 +1,248 @@
+"""
+Offline stand-in for the EDP re:dy portal.
+
+Serves the endpoints used by EdpRedySession (login page, GetActivePower,
+GetSwitchModules, SetStateVar and Logout) with a configurable number of
+modules, latency, error rate and session expiry. Request counters are
+available at /_stats and can be reset with a POST to /_reset.
+
+    python fake_portal.py --modules 100 --latency 0.5 --port 8080
+
+Point EdpRedySession at it with url_base='http://127.0.0.1:8080/EdpPortal/'.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+BASE_PATH = '/EdpPortal/'
+COOKIE_NAME = 'ASP.NET_SessionId'
+
+ENDPOINT_LOGIN = 'login'
+ENDPOINT_LOGIN_PAGE = 'login_page'
+ENDPOINT_ACTIVE_POWER = 'GetActivePower'
+ENDPOINT_SWITCH_MODULES = 'GetSwitchModules'
+ENDPOINT_SET_STATE_VAR = 'SetStateVar'
+ENDPOINT_LOGOUT = 'Logout'
+
+# paths relative to BASE_PATH, the component joins them with a double slash
+ENDPOINT_PATHS = {
+    'Consumption/GetActivePower': ENDPOINT_ACTIVE_POWER,
+    'HomeAutomation/GetSwitchModules': ENDPOINT_SWITCH_MODULES,
+    'HomeAutomation/SetStateVar': ENDPOINT_SET_STATE_VAR,
+    'Login/Logout': ENDPOINT_LOGOUT,
+}
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><head><title>re:dy</title></head>
+<body><form method="post"><input name="username"/>
+<input name="password" type="password"/></form></body></html>
+"""
+
+
+class FakePortal:
+    """State of the fake portal: modules, sessions and counters."""
+
+    def __init__(self, modules=10, latency=0.0, error_rate=0.0,
+                 session_ttl=None, session_max_requests=None, seed=None):
+        """Init the portal."""
+        self.latency = latency
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.session_max_requests = session_max_requests
+        self.requests = Counter()
+        self.errors = Counter()
+        self.rejected = Counter()
+        self._random = random.Random(seed)
+        # token -> [login time, requests done]
+        self._sessions = {}
+        self._modules = [self._make_module(index)
+                         for index in range(modules)]
+
+    def _make_module(self, index):
+        return {
+            'PKID': 'MOD{0:06d}'.format(index),
+            'Name': 'Plug {0}'.format(index),
+            'Capabilities': ['HA_SWITCH', 'HA_POWER_METER'],
+            'OutOfOrder': False,
+            'StateVars': [
+                {'Name': 'RelayState', 'Value': 'true'},
+                {'Name': 'ActivePower', 'Value': '0.0'},
+            ],
+        }
+
+    def stats(self):
+        """Return the counters as a dict."""
+        return {
+            'requests': dict(self.requests),
+            'errors': dict(self.errors),
+            'rejected': dict(self.rejected),
+            'total_requests': sum(self.requests.values()),
+            'logins': self.requests[ENDPOINT_LOGIN],
+            'modules': len(self._modules),
+        }
+
+    def reset(self):
+        """Reset the counters."""
+        self.requests.clear()
+        self.errors.clear()
+        self.rejected.clear()
+
+    def _session_valid(self, request):
+        token = request.cookies.get(COOKIE_NAME)
+        session = self._sessions.get(token)
+        if session is None:
+            return False
+
+        session[1] += 1
+        if self.session_ttl is not None and \
+                time.monotonic() - session[0] > self.session_ttl:
+            del self._sessions[token]
+            return False
+        if self.session_max_requests is not None and \
+                session[1] > self.session_max_requests:
+            del self._sessions[token]
+            return False
+        return True
+
+    def _active_power(self):
+        return sum(float(module['StateVars'][1]['Value'])
+                   for module in self._modules)
+
+    def _step_power(self):
+        """Random walk of the power of the modules that are on."""
+        for module in self._modules:
+            relay, power = module['StateVars']
+            if relay['Value'] != 'true':
+                power['Value'] = '0.0'
+                continue
+            value = float(power['Value']) + self._random.uniform(-0.02, 0.02)
+            power['Value'] = '{0:.4f}'.format(min(max(value, 0.0), 2.0))
+
+    async def handle(self, request):
+        """Handle any request to the portal."""
+        path = request.path
+        if not path.startswith(BASE_PATH):
+            raise web.HTTPNotFound()
+
+        relative = path[len(BASE_PATH):].lstrip('/')
+        if relative == '':
+            endpoint = ENDPOINT_LOGIN if request.method == 'POST' \
+                else ENDPOINT_LOGIN_PAGE
+        elif relative in ENDPOINT_PATHS:
+            endpoint = ENDPOINT_PATHS[relative]
+        else:
+            raise web.HTTPNotFound()
+
+        self.requests[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors[endpoint] += 1
+            return web.Response(status=500, text='Internal Server Error')
+
+        if endpoint == ENDPOINT_LOGIN_PAGE:
+            return web.Response(text=LOGIN_PAGE, content_type='text/html')
+
+        if endpoint == ENDPOINT_LOGIN:
+            return await self._handle_login(request)
+
+        if not self._session_valid(request):
+            self.rejected[endpoint] += 1
+            raise web.HTTPFound(BASE_PATH)
+
+        if endpoint == ENDPOINT_LOGOUT:
+            self._sessions.pop(request.cookies.get(COOKIE_NAME), None)
+            return web.Response(text=LOGIN_PAGE, content_type='text/html')
+
+        if endpoint == ENDPOINT_ACTIVE_POWER:
+            self._step_power()
+            return web.json_response(
+                {'Body': {'ActivePower': self._active_power()}})
+
+        if endpoint == ENDPOINT_SWITCH_MODULES:
+            return web.json_response({'Body': {'Modules': self._modules}})
+
+        return await self._handle_set_state_var(request)
+
+    async def _handle_login(self, request):
+        data = await request.post()
+        if not data.get('username') or not data.get('password'):
+            return web.Response(text=LOGIN_PAGE, content_type='text/html')
+
+        token = uuid.uuid4().hex
+        self._sessions[token] = [time.monotonic(), 0]
+        response = web.Response(text=LOGIN_PAGE, content_type='text/html')
+        response.set_cookie(COOKIE_NAME, token)
+        return response
+
+    async def _handle_set_state_var(self, request):
+        try:
+            payload = await request.json()
+            module_id = payload['devModuleId']
+            key = payload['key']
+            value = payload['value']
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400, text='Bad Request')
+
+        for module in self._modules:
+            if module['PKID'] != module_id:
+                continue
+            for state_var in module['StateVars']:
+                if state_var['Name'] == key:
+                    state_var['Value'] = 'true' if value is True \
+                        else 'false' if value is False else str(value)
+            return web.json_response({'Body': {}})
+
+        return web.Response(status=404, text='Module not found')
+
+
+def create_app(portal):
+    """Create the aiohttp application serving a portal."""
+    async def handle_stats(request):
+        return web.json_response(portal.stats())
+
+    async def handle_reset(request):
+        portal.reset()
+        return web.json_response(portal.stats())
+
+    app = web.Application()
+    app.router.add_get('/_stats', handle_stats)
+    app.router.add_post('/_reset', handle_reset)
+    app.router.add_route('*', '/{tail:.*}', portal.handle)
+    return app
+
+
+def main():
+    """Run the portal until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--modules', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with 500')
+    parser.add_argument('--session-ttl', type=float, default=None,
+                        help='seconds a login stays valid')
+    parser.add_argument('--session-max-requests', type=int, default=None,
+                        help='requests a login stays valid for')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    portal = FakePortal(args.modules, args.latency, args.error_rate,
+                        args.session_ttl, args.session_max_requests,
+                        args.seed)
+    print(json.dumps({'host': args.host, 'port': args.port}), flush=True)
+    web.run_app(create_app(portal), host=args.host, port=args.port,
+                print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the extraction of the devices json from the box page.
+
+Compares, per poll, the CPU time of the previous pipeline (decode the page
+to text, feed it to an HTMLParser looking for the text node holding
+REDYMETER, json.loads it) with extract_devices_json on the page bytes, for
+generated pages of a realistic and a very large size, the same json served
+raw, and any captured pages given with --page.
+
+    python bench_extract.py --nodes 10 200 5000 --page devices.html
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from html.parser import HTMLParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, HERE)
+from pages import load_parser, make_devices, make_page  # noqa: E402
+
+
+class RedyHTMLParser(HTMLParser):
+    """The parser the platform used before."""
+
+    def __init__(self):
+        super().__init__()
+        self._json = ''
+
+    def handle_data(self, data):
+        if data.find('REDYMETER') != -1:
+            self._json = data
+
+    def json(self):
+        return self._json
+
+
+def extract_before(page):
+    """Extract the json like the platform used to."""
+    html_parser = RedyHTMLParser()
+    html_parser.feed(page.decode('utf-8'))
+    html_parser.close()
+    return json.loads(html_parser.json())
+
+
+def bench(function, number):
+    """Return the best time per call in milliseconds."""
+    timer = timeit.Timer(function)
+    return min(timer.repeat(repeat=5, number=number)) / number * 1000
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--nodes', type=int, nargs='+',
+                        default=[10, 200, 5000])
+    parser.add_argument('--padding-rows', type=int, default=200,
+                        help='rows of markup around the json per 10 nodes')
+    parser.add_argument('--page', nargs='*', default=[],
+                        help='captured /api/devices pages to benchmark')
+    args = parser.parse_args()
+
+    redy = load_parser()
+
+    cases = []
+    for nodes in args.nodes:
+        devices = make_devices(nodes)
+        padding = max(20, args.padding_rows * nodes // 10)
+        cases.append(('html {0}'.format(nodes), make_page(devices, padding)))
+        cases.append(('raw {0}'.format(nodes),
+                      json.dumps(devices).encode('utf-8')))
+    for path in args.page:
+        with open(path, 'rb') as page:
+            cases.append((os.path.basename(path), page.read()))
+
+    row = '{0:>20} {1:>10} {2:>12} {3:>12} {4:>9}'
+    print(row.format('page', 'kib', 'before_ms', 'after_ms', 'speedup'))
+    for name, page in cases:
+        if extract_before(page) != redy.extract_devices_json(page):
+            raise RuntimeError('{0}: extractors disagree'.format(name))
+        number = max(1, 200000 // len(page))
+        before = bench(lambda: extract_before(page), number)
+        after = bench(lambda: redy.extract_devices_json(page), number)
+        print(row.format(name, '{0:.1f}'.format(len(page) / 1024),
+                         '{0:.3f}'.format(before), '{0:.3f}'.format(after),
+                         '{0:.2f}x'.format(before / after)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark of the edp_redy_local parsing, per poll.
+
+For each node count, generates a devices page and runs it through the
+parser the way the platform does on every poll (extract the json, parse
+the node readings, reconcile them with the known nodes), reporting:
+
+- CPU time of the extraction and of the parse + reconcile, per poll
+- CPU time of the first poll, which creates the node objects
+- peak allocated memory per poll, and what the parsed json keeps alive
+
+Only the power is decoded unless more --fields are given. Runs without
+Home Assistant, the parser has no dependencies.
+
+    python bench_parse.py --nodes 10 100 1000 10000 --fields power voltage
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import timeit
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, HERE)
+from pages import load_parser, make_devices, make_page  # noqa: E402
+
+
+def make_reconciler(redy):
+    """Return a reconciler doing the minimum per node."""
+    def create(reading):
+        return [reading]
+
+    def update(obj, reading):
+        obj[0] = reading
+
+    return redy.NodeReconciler(create, update)
+
+
+def bench(function, number):
+    """Return the best time per call in milliseconds."""
+    timer = timeit.Timer(function)
+    return min(timer.repeat(repeat=5, number=number)) / number * 1000
+
+
+def bench_nodes(redy, nodes, fields):
+    """Benchmark the polls of a box with a number of nodes."""
+    page = make_page(make_devices(nodes), 20)
+    devices = redy.extract_devices_json(page)
+    reconciler = make_reconciler(redy)
+
+    def poll():
+        reconciler.reconcile(
+            redy.parse_devices(redy.extract_devices_json(page), fields))
+
+    start = time.process_time()
+    poll()
+    first = (time.process_time() - start) * 1000
+
+    number = max(1, 20000 // nodes)
+    extract = bench(lambda: redy.extract_devices_json(page), number)
+    parse = bench(
+        lambda: reconciler.reconcile(redy.parse_devices(devices, fields)),
+        number)
+
+    # allocations are measured apart, tracemalloc skews the timings
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    poll()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = redy.extract_devices_json(page)
+    json_size = tracemalloc.get_traced_memory()[0] - before
+    del kept
+    tracemalloc.stop()
+
+    return {
+        'nodes': nodes,
+        'page_kib': len(page) / 1024,
+        'first_poll_ms': first,
+        'extract_ms': extract,
+        'parse_ms': parse,
+        'poll_ms': extract + parse,
+        'peak_alloc_kib': peak / 1024,
+        'json_kib': json_size / 1024,
+    }
+
+
+def print_results(results):
+    """Print the results as a table."""
+    columns = ['nodes', 'page_kib', 'first_poll_ms', 'extract_ms',
+               'parse_ms', 'poll_ms', 'peak_alloc_kib', 'json_kib']
+    print(' '.join('{0:>14}'.format(column) for column in columns))
+    for result in results:
+        print(' '.join(
+            '{0:>14.3f}'.format(result[column])
+            if isinstance(result[column], float)
+            else '{0:>14}'.format(result[column]) for column in columns))
+
+
+def main():
+    """Parse the arguments and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--nodes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000])
+    parser.add_argument('--fields', nargs='+', default=['power'],
+                        help='fields of the catalogue to decode')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as json')
+    args = parser.parse_args()
+
+    redy = load_parser()
+    results = [bench_nodes(redy, nodes, args.fields)
+               for nodes in args.nodes]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Generated /api/devices pages of a re:dy box, for the benchmarks.
+
+The pages mimic the ones served by the box: the devices json embedded in
+an html page, with a configurable amount of markup around it.
+"""
+import html
+import importlib.util
+import json
+import os
+import random
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PARSER = os.path.join(HERE, '..', '..', 'others', 'edp_redy_local',
+                      'parser.py')
+FIXTURES = os.path.join(HERE, 'fixtures')
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>re:dy box</title>
+<style>{style}</style>
+<script>{script}</script></head>
+<body><div class="nav"><ul>{nav}</ul></div>
+<table class="log">{log}</table>
+<div id="devices">"""
+
+PAGE_TAIL = """</div>
+<div class="footer">EDP re:dy &copy; EDP Comercial</div>
+</body></html>
+"""
+
+
+def load_parser():
+    """Import the edp_redy_local parser from the repository."""
+    spec = importlib.util.spec_from_file_location('edp_redy_local_parser',
+                                                  PARSER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_devices(nodes, seed=1):
+    """Return the devices json of a box with a number of nodes."""
+    rand = random.Random(seed)
+
+    def node(index):
+        return {
+            'ID': '0x{0:016x}'.format(rand.getrandbits(64)),
+            'NAME': 'Plug {0} & co'.format(index),
+            'EMETER:POWER_APLUS': '{0:.3f}'.format(rand.uniform(0, 2)),
+            'EMETER:ENERGY_APLUS': '{0:.3f}'.format(rand.uniform(0, 5000)),
+            'LAST_COMMUNICATION': '2018-11-20T10:00:00Z',
+        }
+
+    meters = nodes // 2
+    return {
+        'REDYMETER': [{'ID': 'RM0', 'NODES': [
+            node(index) for index in range(meters)]}],
+        'ZBENDPOINT': [{'ID': 'ZB0', 'NODES': [
+            node(index) for index in range(meters, nodes)]}],
+        'EDPBOX': [{
+            'SMARTMETER_ID': '0x{0:016x}'.format(rand.getrandbits(64)),
+            'EMETER:POWER_APLUS': '{0:.3f}'.format(rand.uniform(0, 6)),
+            'LAST_COMMUNICATION': '2018-11-20T10:00:00Z',
+        }],
+    }
+
+
+def make_page(devices, padding_rows):
+    """Return the html page embedding the devices json, as bytes."""
+    log = ''.join(
+        '<tr><td>2018-11-20 10:{0:02d}</td><td>event {1}</td></tr>'.format(
+            row % 60, row) for row in range(padding_rows))
+    head = PAGE_HEAD.format(
+        style='td { padding: 2px; } ' * (padding_rows // 10 + 1),
+        script='var refresh = 30;' * (padding_rows // 10 + 1),
+        nav=''.join('<li><a href="/p{0}">Page {0}</a></li>'.format(index)
+                    for index in range(10)),
+        log=log)
+    body = html.escape(json.dumps(devices), quote=False)
+    return (head + body + PAGE_TAIL).encode('utf-8')
+
+
+def load_fixtures():
+    """Return (name, page bytes) of the fixture pages, sorted by name."""
+    fixtures = []
+    for name in sorted(os.listdir(FIXTURES)):
+        if name == 'expected.json':
+            continue
+        with open(os.path.join(FIXTURES, name), 'rb') as page:
+            fixtures.append((name, page.read()))
+    return fixtures
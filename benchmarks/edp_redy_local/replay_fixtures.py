@@ -0,0 +1,65 @@
+"""
+Replay the fixture pages through the edp_redy_local parser.
+
+Every page in fixtures/ is extracted and parsed with all the fields of the
+catalogue, and the readings compared with the ones recorded in
+fixtures/expected.json (null for the pages that must be rejected). Exits
+with 1 on any difference.
+
+    python replay_fixtures.py [--update]
+"""
+import argparse
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, HERE)
+from pages import FIXTURES, load_fixtures, load_parser  # noqa: E402
+
+EXPECTED = os.path.join(FIXTURES, 'expected.json')
+
+
+def replay(redy, page):
+    """Return the readings of a page as lists, None if it is rejected."""
+    try:
+        readings = redy.parse_devices(redy.extract_devices_json(page),
+                                      list(redy.FIELDS))
+    except ValueError:
+        return None
+    return [[reading.node_id, reading.name, reading.last_communication,
+             list(reading.values)] for reading in readings]
+
+
+def main():
+    """Replay the fixtures."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--update', action='store_true',
+                        help='record the current readings as expected')
+    args = parser.parse_args()
+
+    redy = load_parser()
+    results = {name: replay(redy, page) for name, page in load_fixtures()}
+
+    if args.update:
+        with open(EXPECTED, 'w') as expected_file:
+            json.dump(results, expected_file, indent=2, ensure_ascii=False)
+            expected_file.write('\n')
+        return
+
+    with open(EXPECTED) as expected_file:
+        expected = json.load(expected_file)
+
+    failed = False
+    for name, readings in results.items():
+        ok = readings == expected.get(name, False)
+        failed |= not ok
+        print('{0:>24} {1:>8} {2}'.format(
+            name, 'rejected' if readings is None else len(readings),
+            'ok' if ok else 'DIFFERENT'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,61 +7,821 @@ https://home-assistant.io/components/edp_redy/
 
 import aiohttp
 import asyncio
+import bisect
+import html
 import json
 import logging
+import random
 
 import async_timeout
+from array import array
+from collections import deque
 from datetime import timedelta
 
 import voluptuous as vol
 
-from homeassistant.const import (CONF_USERNAME, CONF_PASSWORD,
-                                 EVENT_HOMEASSISTANT_START)
+from homeassistant.const import (CONF_NAME, CONF_USERNAME, CONF_PASSWORD,
+                                 EVENT_HOMEASSISTANT_START,
+                                 EVENT_HOMEASSISTANT_STOP)
 from homeassistant.core import callback
 from homeassistant.helpers import discovery, dispatcher, aiohttp_client
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.entity import Entity
 from homeassistant.helpers.event import async_track_point_in_time
-from homeassistant.util import dt as dt_util
+from homeassistant.helpers.storage import Store
+from homeassistant.util import dt as dt_util, slugify
+
+try:
+    # faster json decoding when available
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 _LOGGER = logging.getLogger(__name__)
 
 DOMAIN = 'edp_redy'
 EDP_REDY = "edp_redy"
-DATA_UPDATE_TOPIC = '{0}_data_update'.format(DOMAIN)
+# formatted with the unique id of the device whose data changed
+DATA_UPDATE_TOPIC = '{0}_data_update_{{0}}'.format(DOMAIN)
+# formatted with the account id, sent when the server becomes (un)available
+AVAILABILITY_TOPIC = '{0}_availability_{{0}}'.format(DOMAIN)
+# formatted with the account id, sent with the PKIDs of the modules that
+# showed up after the first update
+NEW_MODULES_TOPIC = '{0}_new_modules_{{0}}'.format(DOMAIN)
+CONF_ACCOUNT = 'account'
+DEFAULT_ACCOUNT_ID = 'default'
 ACTIVE_POWER_ID = "home_active_power"
+# formatted with the id of the power source
+ENERGY_ID = "{0}_energy"
+# id of the topic sent after every update, for the diagnostic sensors
+DIAGNOSTICS_ID = "diagnostics"
+ATTR_RESTORED = 'restored'
+SERVICE_DUMP_STATS = 'dump_stats'
+EVENT_STATS = '{0}_stats'.format(DOMAIN)
+
+# snapshot of the last fetched data, used to create the entities at startup
+STORAGE_KEY = '{0}_snapshot'.format(DOMAIN)
+ACCOUNT_STORAGE_KEY = '{0}_snapshot_{{0}}'.format(DOMAIN)
+STORAGE_VERSION = 1
+SNAPSHOT_SAVE_DELAY = 300
+# energy totals integrated from the power samples
+ENERGY_STORAGE_KEY = '{0}_energy'.format(DOMAIN)
+ACCOUNT_ENERGY_STORAGE_KEY = '{0}_energy_{{0}}'.format(DOMAIN)
+ENERGY_SAVE_DELAY = 60
 
 URL_BASE = "https://redy.edp.pt/EdpPortal/"
-URL_LOGIN_PAGE = URL_BASE
-URL_GET_ACTIVE_POWER = "{0}/Consumption/GetActivePower".format(URL_BASE)
-URL_GET_SWITCH_MODULES = "{0}/HomeAutomation/GetSwitchModules".format(URL_BASE)
-URL_SET_STATE_VAR = "{0}/HomeAutomation/SetStateVar".format(URL_BASE)
-URL_LOGOUT = "{0}/Login/Logout".format(URL_BASE)
+# formatted with the base url of the session
+URL_LOGIN_PAGE = "{0}"
+URL_GET_ACTIVE_POWER = "{0}/Consumption/GetActivePower"
+URL_GET_SWITCH_MODULES = "{0}/HomeAutomation/GetSwitchModules"
+URL_SET_STATE_VAR = "{0}/HomeAutomation/SetStateVar"
+URL_LOGOUT = "{0}/Login/Logout"
+# local re:dy box, formatted with its host
+URL_LOCAL_DEVICES = "http://{0}:1234/api/devices"
+
+ENDPOINT_LOGIN = "Login"
+ENDPOINT_GET_ACTIVE_POWER = "GetActivePower"
+ENDPOINT_GET_SWITCH_MODULES = "GetSwitchModules"
+ENDPOINT_SET_STATE_VAR = "SetStateVar"
+ENDPOINT_LOGOUT = "Logout"
+ENDPOINTS = [ENDPOINT_LOGIN, ENDPOINT_GET_ACTIVE_POWER,
+             ENDPOINT_GET_SWITCH_MODULES, ENDPOINT_SET_STATE_VAR,
+             ENDPOINT_LOGOUT]
+
+# state vars decoded into typed values
+STATE_VAR_RELAY_STATE = "RelayState"
+STATE_VAR_ACTIVE_POWER = "ActivePower"
+
+CONF_ADAPTIVE_POLLING = 'adaptive_polling'
+CONF_MIN_UPDATE_INTERVAL = 'min_update_interval'
+CONF_MAX_UPDATE_INTERVAL = 'max_update_interval'
+CONF_STATISTICS_WINDOWS = 'statistics_windows'
+CONF_LOCAL_HOST = 'local_host'
 
 UPDATE_INTERVAL = 30
+# windows (in minutes) of the rolling power statistics
+DEFAULT_STATISTICS_WINDOWS = [15]
+DEFAULT_MIN_UPDATE_INTERVAL = 10
+DEFAULT_MAX_UPDATE_INTERVAL = 120
+MAX_BACKOFF_INTERVAL = 900
+# relative change of the home power (over at least 100 W) that is "fast"
+ADAPTIVE_POWER_CHANGE = 0.1
+ADAPTIVE_MIN_POWER = 100
 DEFAULT_TIMEOUT = 30
-SESSION_TIME = 59
+LOCAL_TIMEOUT = 5
+# samples further apart (in seconds) are not integrated: longer than the
+# longest backoff plus the time an update can take, so integration goes on
+# while the server is failing
+MAX_INTEGRATION_GAP = MAX_BACKOFF_INTERVAL + 2 * DEFAULT_TIMEOUT
+# while the local box is reachable and reads all the modules' power,
+# seconds between cloud module fetches of accounts without switches
+LOCAL_CLOUD_REFRESH_INTERVAL = 300
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, DEFAULT_TIMEOUT)
+MAX_CONCURRENT_COMMANDS = 4
+# delay of the refresh done after commands, to confirm the new state
+COMMAND_REFRESH_DELAY = 3
+LOGIN_STATS_WINDOW = 3600
+# consecutive failures that open the circuit breaker, and for how long (s)
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 300
+
+# responses meaning the session expired (redirects go to the login page)
+SESSION_REJECTED_STATUS = (301, 302, 303, 307, 308, 401, 403)
+
+ACCOUNT_SCHEMA = vol.Schema({
+    vol.Required(CONF_USERNAME): cv.string,
+    vol.Required(CONF_PASSWORD): cv.string,
+    vol.Optional(CONF_NAME): cv.string,
+    vol.Optional(CONF_LOCAL_HOST): cv.string,
+    vol.Optional(CONF_ADAPTIVE_POLLING, default=False): cv.boolean,
+    vol.Optional(CONF_MIN_UPDATE_INTERVAL,
+                 default=DEFAULT_MIN_UPDATE_INTERVAL): cv.positive_int,
+    vol.Optional(CONF_MAX_UPDATE_INTERVAL,
+                 default=DEFAULT_MAX_UPDATE_INTERVAL): cv.positive_int,
+    vol.Optional(CONF_STATISTICS_WINDOWS,
+                 default=DEFAULT_STATISTICS_WINDOWS):
+        vol.All(cv.ensure_list, [cv.positive_int]),
+})
+
+
+def _has_unique_names(accounts):
+    """Validate that several accounts can be told apart."""
+    if len(accounts) > 1:
+        names = [slugify(account.get(CONF_NAME, '')) for account in accounts]
+        if '' in names or len(set(names)) != len(names):
+            raise vol.Invalid("Each account needs a different name")
+    return accounts
+
 
 CONFIG_SCHEMA = vol.Schema({
-    DOMAIN: vol.Schema({
-        vol.Required(CONF_USERNAME): cv.string,
-        vol.Required(CONF_PASSWORD): cv.string
-    })
+    DOMAIN: vol.All(cv.ensure_list, [ACCOUNT_SCHEMA], _has_unique_names)
 }, extra=vol.ALLOW_EXTRA)
 
 
+def _decode_body_field(body, field):
+    """Decode a json response and return a field of its Body.
+
+    Returns None if the field is missing, raises ValueError if the response
+    is not valid json.
+    """
+    try:
+        return json_loads(body)["Body"][field]
+    except (KeyError, TypeError):
+        return None
+
+
+def _log_body(message, body):
+    """Log a response body, only decoding it if debug logging is enabled."""
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        _LOGGER.debug(message, body.decode('utf-8', 'replace'))
+
+
+def _delayed_saver(store, data_func, delay):
+    """Return a callback saving data_func() to store within delay seconds.
+
+    Store.async_delay_save restarts its timer on every call: called on
+    every update, more frequent than the delay, it would only write when
+    Home Assistant stops. It is only called when no save is pending.
+    """
+    pending = False
+
+    def data():
+        nonlocal pending
+        pending = False
+        return data_func()
+
+    @callback
+    def async_save():
+        nonlocal pending
+        if not pending:
+            pending = True
+            store.async_delay_save(data, delay)
+
+    return async_save
+
+
+def _extract_local_json(body):
+    """Return the json document served by the local box.
+
+    The box serves either the json alone or an html page with the json as
+    the text of an element. Same extraction as extract_devices_json in the
+    edp_redy_local platform.
+    """
+    if body[:64].lstrip()[:1] == b'{':
+        return json.loads(body.decode('utf-8'))
+
+    marker = body.find(b'REDYMETER')
+    if marker == -1:
+        raise ValueError("No device data in the page")
+
+    # the text of the element holding the marker, as an html parser sees it
+    tag = body.rfind(b'<', 0, marker)
+    start = body.find(b'>', tag, marker) + 1 if tag != -1 else 0
+    start = body.find(b'{', start, marker)
+    if start == -1:
+        raise ValueError("No device data in the page")
+    end = body.find(b'<', marker)
+    if end == -1:
+        end = len(body)
+
+    text = body[start:end].decode('utf-8')
+    if '&' in text:
+        text = html.unescape(text)
+    return json.JSONDecoder().raw_decode(text)[0]
+
+
+def _parse_local_readings(devices):
+    """Return the home power and the node readings of the local box.
+
+    The node readings map the node ids to their name and power, in W.
+    """
+    if not isinstance(devices, dict):
+        raise ValueError("Device data is not an object")
+
+    def to_watts(value):
+        try:
+            return float(value) * 1000
+        except (TypeError, ValueError):
+            return None
+
+    nodes = {}
+    for type_tag in ("REDYMETER", "ZBENDPOINT"):
+        for device in devices.get(type_tag) or ():
+            for node in device.get("NODES") or ():
+                if "ID" not in node or "EMETER:POWER_APLUS" not in node:
+                    continue
+                name = node.get("NAME")
+                nodes[node["ID"]] = (name if isinstance(name, str) else "",
+                                     to_watts(node["EMETER:POWER_APLUS"]))
+
+    home_power = None
+    if devices.get("EDPBOX"):
+        home_power = to_watts(devices["EDPBOX"][0].get("EMETER:POWER_APLUS"))
+
+    return home_power, nodes
+
+
+def _decode_state_var(pkid, name, value):
+    """Convert the raw value of a state var to its python type."""
+    if name == STATE_VAR_RELAY_STATE:
+        return value is True or value == "true"
+    if name == STATE_VAR_ACTIVE_POWER:
+        # the server reports kW
+        try:
+            return float(value) * 1000
+        except (ValueError, TypeError):
+            _LOGGER.error("Could not parse power for %s", pkid)
+            return None
+    return value
+
+
+class EdpRedyModule:
+    """Decoded data of a re:dy module."""
+
+    __slots__ = ('pkid', 'name', 'capabilities', 'out_of_order',
+                 'state_vars')
+
+    def __init__(self, pkid, name, capabilities, out_of_order, state_vars):
+        """Init the module."""
+        self.pkid = pkid
+        self.name = name
+        self.capabilities = capabilities
+        self.out_of_order = out_of_order
+        self.state_vars = state_vars
+
+    @classmethod
+    def from_json(cls, module):
+        """Decode a module as received from the server."""
+        pkid = module['PKID']
+        state_vars = {}
+        for state_var in module.get("StateVars", ()):
+            name = state_var["Name"]
+            state_vars[name] = _decode_state_var(pkid, name,
+                                                 state_var["Value"])
+
+        return cls(pkid, module.get('Name', ''),
+                   frozenset(module.get("Capabilities", ())),
+                   bool(module.get("OutOfOrder", False)), state_vars)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a module from the dict made by as_dict."""
+        return cls(data['PKID'], data['Name'],
+                   frozenset(data['Capabilities']), data['OutOfOrder'],
+                   data['StateVars'])
+
+    def as_dict(self):
+        """Return the module as a json serializable dict."""
+        return {'PKID': self.pkid, 'Name': self.name,
+                'Capabilities': sorted(self.capabilities),
+                'OutOfOrder': self.out_of_order,
+                'StateVars': self.state_vars}
+
+    @property
+    def relay_state(self):
+        """Return the relay state, None if the module has no relay."""
+        return self.state_vars.get(STATE_VAR_RELAY_STATE)
+
+    @property
+    def active_power(self):
+        """Return the active power in W, None if unknown."""
+        return self.state_vars.get(STATE_VAR_ACTIVE_POWER)
+
+    def same_state(self, other):
+        """Check if other holds the same state as this module."""
+        return other is not None and \
+            self.out_of_order == other.out_of_order and \
+            self.state_vars == other.state_vars
+
+    def __repr__(self):
+        """Return the representation of the module."""
+        return "<EdpRedyModule {0} {1!r} out_of_order={2} {3}>".format(
+            self.pkid, self.name, self.out_of_order, self.state_vars)
+
+
+class RollingWindow:
+    """Min, max and mean of the samples of the last window seconds.
+
+    Samples are kept in a ring buffer of arrays that grows as needed. The
+    sum and the monotonic queues of the min and max candidates are updated
+    as samples come and go, so each sample costs O(1) amortized.
+    """
+
+    __slots__ = ('window', '_times', '_values', '_head', '_tail', '_sum',
+                 '_min_queue', '_max_queue')
+
+    def __init__(self, window, capacity=64):
+        """Init the window, window in seconds."""
+        self.window = window
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        # sequence numbers of the oldest sample and of the next one
+        self._head = 0
+        self._tail = 0
+        self._sum = 0.0
+        self._min_queue = deque()
+        self._max_queue = deque()
+
+    def __len__(self):
+        """Return the number of samples in the window."""
+        return self._tail - self._head
+
+    def add(self, time, value):
+        """Add a sample taken at time (in seconds)."""
+        self._evict(time - self.window)
+        if len(self) == len(self._values):
+            self._grow()
+
+        capacity = len(self._values)
+        index = self._tail % capacity
+        self._times[index] = time
+        self._values[index] = value
+        self._sum += value
+
+        values = self._values
+        while self._min_queue and \
+                values[self._min_queue[-1] % capacity] >= value:
+            self._min_queue.pop()
+        self._min_queue.append(self._tail)
+        while self._max_queue and \
+                values[self._max_queue[-1] % capacity] <= value:
+            self._max_queue.pop()
+        self._max_queue.append(self._tail)
+
+        self._tail += 1
+
+    def _evict(self, limit):
+        capacity = len(self._values)
+        while self._head < self._tail and \
+                self._times[self._head % capacity] < limit:
+            self._sum -= self._values[self._head % capacity]
+            if self._min_queue[0] == self._head:
+                self._min_queue.popleft()
+            if self._max_queue[0] == self._head:
+                self._max_queue.popleft()
+            self._head += 1
+
+        if self._head == self._tail:
+            # avoid accumulating rounding errors
+            self._sum = 0.0
+
+    def _grow(self):
+        old_capacity = len(self._values)
+        capacity = old_capacity * 2
+        times = array('d', bytes(8 * capacity))
+        values = array('d', bytes(8 * capacity))
+        for seq in range(self._head, self._tail):
+            times[seq % capacity] = self._times[seq % old_capacity]
+            values[seq % capacity] = self._values[seq % old_capacity]
+        self._times = times
+        self._values = values
+
+    @property
+    def minimum(self):
+        """Return the minimum of the window, None if empty."""
+        if not self._min_queue:
+            return None
+        return self._values[self._min_queue[0] % len(self._values)]
+
+    @property
+    def maximum(self):
+        """Return the maximum of the window, None if empty."""
+        if not self._max_queue:
+            return None
+        return self._values[self._max_queue[0] % len(self._values)]
+
+    @property
+    def mean(self):
+        """Return the mean of the window, None if empty."""
+        if self._head == self._tail:
+            return None
+        return self._sum / (self._tail - self._head)
+
+
+class PowerStatistics:
+    """Rolling statistics of a power source over several windows."""
+
+    __slots__ = ('_windows', '_summary')
+
+    def __init__(self, windows):
+        """Init the statistics, windows in minutes."""
+        self._windows = [(minutes, RollingWindow(minutes * 60))
+                         for minutes in windows]
+        self._summary = None
+
+    def add(self, time, power):
+        """Add a sample, return True if the rounded statistics changed."""
+        for _, window in self._windows:
+            window.add(time, power)
+
+        summary = tuple(
+            (round(window.minimum), round(window.maximum),
+             round(window.mean)) for _, window in self._windows)
+        changed = summary != self._summary
+        self._summary = summary
+        return changed
+
+    def as_attributes(self):
+        """Return the statistics as state attributes."""
+        attrs = {}
+        for minutes, window in self._windows:
+            if not len(window):
+                continue
+            attrs['power_min_{0}min'.format(minutes)] = \
+                round(window.minimum, 1)
+            attrs['power_max_{0}min'.format(minutes)] = \
+                round(window.maximum, 1)
+            attrs['power_mean_{0}min'.format(minutes)] = \
+                round(window.mean, 1)
+        return attrs
+
+
+class EnergyIntegrator:
+    """Energy (kWh) integrated from power samples with the trapezoidal rule.
+
+    Intervals longer than max_gap (MAX_INTEGRATION_GAP by default),
+    intervals ending in an unknown power and timestamps going backwards
+    (e.g. a clock reset) are not integrated: integration restarts from the
+    next sample.
+    """
+
+    __slots__ = ('total', 'last_time', 'last_power')
+
+    def __init__(self, total=0.0, last_time=None, last_power=None):
+        """Init the integrator, times are unix timestamps."""
+        self.total = total
+        self.last_time = last_time
+        self.last_power = last_power
+
+    def add(self, time, power, max_gap=MAX_INTEGRATION_GAP):
+        """Add a power sample (W), return True if the total changed."""
+        if power is None:
+            self.last_time = None
+            return False
+
+        power = max(power, 0.0)
+        last_time, last_power = self.last_time, self.last_power
+        self.last_time = time
+        self.last_power = power
+        if last_time is None or not \
+                0 < time - last_time <= max_gap:
+            return False
+
+        self.total += (last_power + power) / 2 * (time - last_time) / 3600000
+        return True
+
+    def as_list(self):
+        """Return the state in compact form, for storage."""
+        return [self.total, self.last_time, self.last_power]
+
+
+class EdpRedyEndpointStats:
+    """Latency histogram and error counters of a server endpoint."""
+
+    __slots__ = ('responses', 'latency_sum', 'latency_max',
+                 'latency_buckets', 'timeouts', 'client_errors',
+                 'bad_status', 'rejected', 'parse_errors',
+                 'last_payload_size', 'payload_bytes')
+
+    def __init__(self):
+        """Init the counters."""
+        self.responses = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        # the last bucket counts the latencies above all bounds
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.timeouts = 0
+        self.client_errors = 0
+        self.bad_status = 0
+        self.rejected = 0
+        self.parse_errors = 0
+        self.last_payload_size = None
+        self.payload_bytes = 0
+
+    def add_response(self, latency, payload_size=None):
+        """Count a response received after latency seconds."""
+        self.responses += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS,
+                                                latency)] += 1
+        if payload_size is not None:
+            self.last_payload_size = payload_size
+            self.payload_bytes += payload_size
+
+    def add_error(self, error):
+        """Count a request that got no response."""
+        if isinstance(error, asyncio.TimeoutError):
+            self.timeouts += 1
+        else:
+            self.client_errors += 1
+
+    @property
+    def latency_mean(self):
+        """Return the mean latency in seconds, None if no responses."""
+        if not self.responses:
+            return None
+        return self.latency_sum / self.responses
+
+    def as_dict(self):
+        """Return the counters as a dict."""
+        buckets = ['<={0}s'.format(bound) for bound in LATENCY_BUCKETS]
+        buckets.append('>{0}s'.format(LATENCY_BUCKETS[-1]))
+        mean = self.latency_mean
+        return {
+            'responses': self.responses,
+            'latency_mean': round(mean, 3) if mean is not None else None,
+            'latency_max': round(self.latency_max, 3),
+            'latency_histogram': dict(zip(buckets, self.latency_buckets)),
+            'timeouts': self.timeouts,
+            'client_errors': self.client_errors,
+            'bad_status': self.bad_status,
+            'rejected': self.rejected,
+            'parse_errors': self.parse_errors,
+            'last_payload_size': self.last_payload_size,
+            'payload_bytes': self.payload_bytes,
+        }
+
+
+class EdpRedyCircuitBreaker:
+    """Stop calling the server while it keeps failing.
+
+    After threshold consecutive failures the breaker opens and requests fail
+    right away. After the cooldown one request is let through: if it
+    succeeds the breaker closes, otherwise it opens again.
+    """
+
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half_open'
+
+    def __init__(self, hass, threshold, cooldown, state_callback):
+        """Init the breaker."""
+        self._hass = hass
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._state_callback = state_callback
+        self.state = self.STATE_CLOSED
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_closed(self):
+        """Return True if requests flow normally."""
+        return self.state == self.STATE_CLOSED
+
+    def allow_request(self):
+        """Check if a request can be made now."""
+        if self.state == self.STATE_CLOSED:
+            return True
+        if self.state == self.STATE_OPEN and \
+                self._hass.loop.time() - self._opened_at >= self._cooldown:
+            _LOGGER.debug("Probing the server")
+            self.state = self.STATE_HALF_OPEN
+            return True
+        # open, or half open with the probe in flight
+        return False
+
+    def record_success(self):
+        """Count a request that reached the server."""
+        self._failures = 0
+        if self.state != self.STATE_CLOSED:
+            _LOGGER.warning("Server available again")
+            self.state = self.STATE_CLOSED
+            self._state_callback()
+
+    def record_failure(self):
+        """Count a request that failed."""
+        self._failures += 1
+        if self.state == self.STATE_HALF_OPEN:
+            _LOGGER.debug("Probe failed")
+        elif self.state == self.STATE_CLOSED and \
+                self._failures >= self._threshold:
+            _LOGGER.warning("Server failed %s times, pausing requests "
+                            "for %s seconds", self._failures, self._cooldown)
+        else:
+            return
+
+        was_closed = self.state == self.STATE_CLOSED
+        self.state = self.STATE_OPEN
+        self._opened_at = self._hass.loop.time()
+        if was_closed:
+            self._state_callback()
+
+
+class EdpRedyCommandQueue:
+    """Queue of SetStateVar commands with bounded concurrency.
+
+    Commands for different modules are sent concurrently, those for the
+    same module and state var one at a time, in order. While a command waits
+    for a free slot or for the previous one to return, a new command for the
+    same module and state var replaces it. Callers whose command was
+    replaced by a different one get False, as their command was not sent.
+    """
+
+    def __init__(self, hass, send_method, max_concurrent):
+        """Init the queue."""
+        self._hass = hass
+        self._send_method = send_method
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        # (module id, state var) -> [payload to send, [(future, payload)]]
+        self._pending = {}
+        # (module id, state var) being sent, or waiting for a slot
+        self._in_flight = set()
+
+    async def async_send(self, json_payload):
+        """Queue a command and wait for its result."""
+        future = self._hass.loop.create_future()
+        key = (json_payload["devModuleId"], json_payload["key"])
+
+        entry = self._pending.get(key)
+        if entry is not None:
+            _LOGGER.debug("Replacing pending command for %s", key)
+            entry[0] = json_payload
+            entry[1].append((future, json_payload))
+        else:
+            self._pending[key] = [json_payload, [(future, json_payload)]]
+            if key not in self._in_flight:
+                # one task per key, it sends whatever is pending for it
+                self._in_flight.add(key)
+                self._hass.async_create_task(self._async_process(key))
+
+        return await future
+
+    async def _async_process(self, key):
+        try:
+            while key in self._pending:
+                async with self._semaphore:
+                    json_payload, waiters = self._pending.pop(key)
+                    try:
+                        result = await self._send_method(json_payload)
+                    except Exception:  # pylint: disable=broad-except
+                        _LOGGER.exception(
+                            "Unexpected error while sending command")
+                        result = False
+
+                for future, waiter_payload in waiters:
+                    if not future.done():
+                        future.set_result(
+                            result and waiter_payload == json_payload)
+        finally:
+            self._in_flight.discard(key)
+
+
 class EdpRedySession:
     """Representation of an http session to the service."""
 
-    def __init__(self, hass, username, password):
+    def __init__(self, hass, username, password, url_base=URL_BASE,
+                 account=None, websession=None,
+                 statistics_windows=DEFAULT_STATISTICS_WINDOWS,
+                 local_host=None,
+                 max_update_interval=DEFAULT_MAX_UPDATE_INTERVAL):
         """Init the session."""
+        self.account = account
+        self.account_id = slugify(account) if account else DEFAULT_ACCOUNT_ID
+        self._websession = websession
+        self._url_base = url_base
         self._username = username
         self._password = password
         self._session = None
         self._session_time = dt_util.utcnow()
+        # counts the login attempts, successful or not
+        self._session_generation = 0
+        self._login_times = deque()
         self._hass = hass
+        self._session_lock = asyncio.Lock()
         self.modules_dict = {}
         self.values_dict = {}
+        self.updated_ids = set()
+        self.added_ids = set()
+        # True while the data comes from a snapshot, not from the server
+        self.restored = False
+        # set by async_setup, used to refresh the data after commands
+        self.scheduler = None
+        self._command_queue = EdpRedyCommandQueue(
+            hass, self._async_send_state_var, MAX_CONCURRENT_COMMANDS)
+        self.stats = {endpoint: EdpRedyEndpointStats()
+                      for endpoint in ENDPOINTS}
+        # local box preferred for the power readings, see async_update
+        self._local_url = URL_LOCAL_DEVICES.format(local_host) \
+            if local_host else None
+        self.power_source = None
+        # ids of the power sources (modules, ACTIVE_POWER_ID) read locally
+        self._local_ids = set()
+        self._module_names = {}
+        # time of the last attempt to fetch the modules, and its failures
+        self._modules_time = None
+        self._modules_failures = 0
+        self._cloud_refresh_needed = False
+        # rolling statistics and energy of the home and module power
+        self.power_stats = {}
+        self.energy = {}
+        self._statistics_windows = statistics_windows
+        # adaptive polling may wait longer than a backoff between updates
+        self._integration_gap = max(
+            MAX_INTEGRATION_GAP, max_update_interval + 2 * DEFAULT_TIMEOUT)
+        self.breaker = EdpRedyCircuitBreaker(
+            hass, BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN,
+            self._availability_changed)
+
+    def _url(self, url_format):
+        return url_format.format(self._url_base)
+
+    @property
+    def available(self):
+        """Return False while requests to the server are paused."""
+        return self.breaker.is_closed
+
+    def is_local(self, device_id):
+        """Check if the power of a device currently comes from the box."""
+        return device_id in self._local_ids
+
+    def _record_power(self, device_id, power):
+        """Add a power sample to the statistics and energy of a device.
+
+        An unknown power is left out of the statistics but still ends the
+        interval being integrated.
+        """
+        if power is not None:
+            stats = self.power_stats.get(device_id)
+            if stats is None:
+                stats = self.power_stats[device_id] = PowerStatistics(
+                    self._statistics_windows)
+            if stats.add(self._hass.loop.time(), power):
+                self.updated_ids.add(device_id)
+
+        integrator = self.energy.get(device_id)
+        if integrator is None:
+            integrator = self.energy[device_id] = EnergyIntegrator()
+        total = round(integrator.total, 3)
+        integrator.add(dt_util.utcnow().timestamp(), power,
+                       self._integration_gap)
+        if round(integrator.total, 3) != total:
+            self.updated_ids.add(ENERGY_ID.format(device_id))
+
+    def energy_snapshot(self):
+        """Return the energy totals in compact form, for storage."""
+        return {device_id: integrator.as_list()
+                for device_id, integrator in self.energy.items()}
+
+    def restore_energy(self, snapshot):
+        """Load the energy totals saved by energy_snapshot."""
+        try:
+            self.energy = {device_id: EnergyIntegrator(*values)
+                           for device_id, values in snapshot.items()}
+        except (AttributeError, TypeError):
+            _LOGGER.warning("Ignoring invalid energy totals")
+
+    def _availability_changed(self):
+        dispatcher.async_dispatcher_send(
+            self._hass, AVAILABILITY_TOPIC.format(self.account_id))
+
+    def unique_id(self, device_id):
+        """Return the id of a device namespaced by the account."""
+        if self.account is None:
+            return device_id
+        return "{0}_{1}".format(self.account_id, device_id)
 
     async def async_init_session(self):
         """Create a new http session."""
@@ -69,29 +829,41 @@ class EdpRedySession:
                         'password': self._password,
                         'screenWidth': '1920', 'screenHeight': '1080'}
 
+        stats = self.stats[ENDPOINT_LOGIN]
+
         try:
             # create session and fetch login page
-            session = aiohttp_client.async_get_clientsession(self._hass)
+            session = self._websession or \
+                aiohttp_client.async_get_clientsession(self._hass)
+            start = self._hass.loop.time()
             with async_timeout.timeout(DEFAULT_TIMEOUT, loop=self._hass.loop):
-                resp = await session.get(URL_LOGIN_PAGE)
+                resp = await session.get(self._url(URL_LOGIN_PAGE))
 
-        except (asyncio.TimeoutError, aiohttp.ClientError):
+        except (asyncio.TimeoutError, aiohttp.ClientError) as err:
+            stats.add_error(err)
             _LOGGER.error("Error while accessing login page")
             return None
 
+        stats.add_response(self._hass.loop.time() - start)
         if resp.status != 200:
+            stats.bad_status += 1
             _LOGGER.error("Login page returned status code %s", resp.status)
             return None
 
         try:
+            start = self._hass.loop.time()
             with async_timeout.timeout(DEFAULT_TIMEOUT, loop=self._hass.loop):
-                resp = await session.post(URL_LOGIN_PAGE, data=payload_auth)
+                resp = await session.post(self._url(URL_LOGIN_PAGE),
+                                          data=payload_auth)
 
-        except (asyncio.TimeoutError, aiohttp.ClientError):
+        except (asyncio.TimeoutError, aiohttp.ClientError) as err:
+            stats.add_error(err)
             _LOGGER.error("Error while doing login post")
             return None
 
+        stats.add_response(self._hass.loop.time() - start)
         if resp.status != 200:
+            stats.bad_status += 1
             _LOGGER.error("Login post returned status code %s", resp.status)
             return None
 
@@ -99,188 +871,666 @@ class EdpRedySession:
 
     async def async_logout(self):
         """Logout from the current session."""
+        if self._session is None:
+            return True
+
         _LOGGER.debug("Logout")
+        stats = self.stats[ENDPOINT_LOGOUT]
 
         try:
+            start = self._hass.loop.time()
             with async_timeout.timeout(DEFAULT_TIMEOUT, loop=self._hass.loop):
-                resp = await self._session.get(URL_LOGOUT)
+                resp = await self._session.get(self._url(URL_LOGOUT))
 
-        except (asyncio.TimeoutError, aiohttp.ClientError):
+        except (asyncio.TimeoutError, aiohttp.ClientError) as err:
+            stats.add_error(err)
             _LOGGER.error("Error while doing logout")
             return False
+        finally:
+            self._session = None
 
+        stats.add_response(self._hass.loop.time() - start)
         if resp.status != 200:
+            stats.bad_status += 1
             _LOGGER.error("Logout returned status code %s", resp.status)
             return False
 
         return True
 
+    @property
+    def session_age(self):
+        """Return the seconds since the current login, None if logged out."""
+        if self._session is None:
+            return None
+        return (dt_util.utcnow() - self._session_time).total_seconds()
+
+    def diagnostics(self):
+        """Return the session statistics as a dict."""
+        return {
+            'account': self.account_id,
+            'breaker': self.breaker.state,
+            'power_source': self.power_source,
+            'session_age': self.session_age,
+            'logins_last_hour': self.logins_last_hour,
+            'endpoints': {endpoint: stats.as_dict()
+                          for endpoint, stats in self.stats.items()},
+        }
+
+    @property
+    def logins_last_hour(self):
+        """Return how many logins were done in the last hour."""
+        limit = dt_util.utcnow() - timedelta(seconds=LOGIN_STATS_WINDOW)
+        while self._login_times and self._login_times[0] < limit:
+            self._login_times.popleft()
+        return len(self._login_times)
+
     async def async_validate_session(self):
         """Check the current session and create a new one if needed."""
-        if self._session is not None:
-            session_life = dt_util.utcnow() - self._session_time
-            if session_life.total_seconds() < SESSION_TIME:
-                """ Session valid, nothing to do """
+        generation = self._session_generation
+        # concurrent fetches must not both decide to login at the same time
+        async with self._session_lock:
+            if self._session is not None:
+                # keep the session until the server rejects it
                 return True
+            if generation != self._session_generation:
+                # a login failed while waiting, do not try again right away
+                return False
+
+            self._session = await self.async_init_session()
+            self._session_generation += 1
+            if self._session is None:
+                return False
+
+            self._session_time = dt_util.utcnow()
+            self._login_times.append(self._session_time)
+            _LOGGER.debug("Logged in (%s logins in the last hour)",
+                          self.logins_last_hour)
+            return True
+
+    async def _async_invalidate_session(self, generation):
+        """Drop the session the server rejected, if not replaced already."""
+        async with self._session_lock:
+            if generation == self._session_generation:
+                self._session = None
+
+    @staticmethod
+    def _is_session_rejected(resp, body, expect_json):
+        """Check if the server refused the request due to the session."""
+        if resp.status in SESSION_REJECTED_STATUS:
+            return True
+        if expect_json and resp.status == 200:
+            # expired sessions get the html login page instead of json
+            return 'html' in resp.content_type or \
+                body.lstrip().startswith(b'<')
+        return False
 
-            """ Session is older than SESSION_TIME: logout """
-            await self.async_logout()
-            self._session = None
+    async def _async_post(self, url, endpoint, action, expect_json=True,
+                          **kwargs):
+        """Post to the server and return the raw response body.
 
-        """ not valid, create new session """
-        self._session = await self.async_init_session()
-        self._session_time = dt_util.utcnow()
-        return True if self._session is not None else False
+        If the server rejects the session, login again and retry once.
+        Returns None on failure.
+        """
+        stats = self.stats[endpoint]
+        for _ in range(2):
+            if not self.breaker.allow_request():
+                _LOGGER.debug("Server unavailable, not %s", action)
+                return None
+
+            if not await self.async_validate_session():
+                self.breaker.record_failure()
+                return None
+            generation = self._session_generation
+
+            try:
+                start = self._hass.loop.time()
+                with async_timeout.timeout(DEFAULT_TIMEOUT,
+                                           loop=self._hass.loop):
+                    resp = await self._session.post(
+                        url, allow_redirects=False, **kwargs)
+                    body = await resp.read()
+            except (asyncio.TimeoutError, aiohttp.ClientError) as err:
+                stats.add_error(err)
+                self.breaker.record_failure()
+                _LOGGER.error("Error while %s", action)
+                return None
+
+            stats.add_response(self._hass.loop.time() - start, len(body))
+
+            if self._is_session_rejected(resp, body, expect_json):
+                stats.rejected += 1
+                # the server answered, only the session must be renewed
+                self.breaker.record_success()
+                _LOGGER.debug("Session rejected while %s", action)
+                await self._async_invalidate_session(generation)
+                continue
+
+            if resp.status != 200:
+                stats.bad_status += 1
+                self.breaker.record_failure()
+                _LOGGER.error("Server returned status code %s while %s",
+                              resp.status, action)
+                return None
+
+            self.breaker.record_success()
+            return body
+
+        _LOGGER.error("Session rejected right after login while %s", action)
+        return None
 
     async def async_fetch_active_power(self):
         """Fetch new data from the server."""
-        if not await self.async_validate_session():
-            return False
-
-        try:
-            with async_timeout.timeout(DEFAULT_TIMEOUT, loop=self._hass.loop):
-                resp = await self._session.post(URL_GET_ACTIVE_POWER)
-        except (asyncio.TimeoutError, aiohttp.ClientError):
-            _LOGGER.error("Error while getting active power")
-            return False
-        if resp.status != 200:
-            _LOGGER.error("Getting active power returned status code %s",
-                          resp.status)
+        body = await self._async_post(
+            self._url(URL_GET_ACTIVE_POWER), ENDPOINT_GET_ACTIVE_POWER,
+            "getting active power")
+        if body is None:
             return False
 
-        active_power_str = await resp.text()
-        _LOGGER.debug("Fetched Active Power:\n" + active_power_str)
-
-        if active_power_str is None:
-            return False
+        _log_body("Fetched Active Power:\n%s", body)
 
         try:
-            updated_dict = json.loads(active_power_str)
-        except (json.decoder.JSONDecodeError, TypeError):
+            active_power = _decode_body_field(body, "ActivePower")
+        except ValueError:
+            self.stats[ENDPOINT_GET_ACTIVE_POWER].parse_errors += 1
             _LOGGER.error("Error parsing active power json. Received: \n %s",
-                          active_power_str)
+                          body.decode('utf-8', 'replace'))
             return False
 
-        if "Body" not in updated_dict:
-            return False
-        if "ActivePower" not in updated_dict["Body"]:
+        if active_power is None:
             return False
 
         try:
-            self.values_dict[ACTIVE_POWER_ID] = \
-                updated_dict["Body"]["ActivePower"] * 1000
-        except ValueError:
+            active_power = active_power * 1000
+        except (ValueError, TypeError):
             _LOGGER.error(
                 "Could not parse value: ActivePower")
-            self.values_dict[ACTIVE_POWER_ID] = None
+            active_power = None
+
+        if ACTIVE_POWER_ID not in self.values_dict or \
+                self.values_dict[ACTIVE_POWER_ID] != active_power:
+            self.values_dict[ACTIVE_POWER_ID] = active_power
+            self.updated_ids.add(ACTIVE_POWER_ID)
+        self._record_power(ACTIVE_POWER_ID, active_power)
 
         return True
 
     async def async_fetch_modules(self):
         """Fetch new data from the server."""
-        if not await self.async_validate_session():
+        body = await self._async_post(self._url(URL_GET_SWITCH_MODULES),
+                                      ENDPOINT_GET_SWITCH_MODULES,
+                                      "getting switch modules",
+                                      data={"filter": 1})
+        if body is None:
             return False
 
+        _log_body("Fetched Modules:\n%s", body)
+
         try:
-            with async_timeout.timeout(DEFAULT_TIMEOUT, loop=self._hass.loop):
-                resp = await self._session.post(URL_GET_SWITCH_MODULES,
-                                                data={"filter": 1})
-        except (asyncio.TimeoutError, aiohttp.ClientError):
-            _LOGGER.error("Error while getting switch modules")
+            modules = _decode_body_field(body, "Modules")
+        except ValueError:
+            self.stats[ENDPOINT_GET_SWITCH_MODULES].parse_errors += 1
+            _LOGGER.error("Error parsing modules json. Received: \n %s",
+                          body.decode('utf-8', 'replace'))
             return False
-        if resp.status != 200:
-            _LOGGER.error("Getting switch modules returned status code %s",
-                          resp.status)
+
+        if modules is None:
             return False
 
-        modules_str = await resp.text()
-        _LOGGER.debug("Fetched Modules:\n" + modules_str)
+        fetched_ids = set()
+        for module_json in modules:
+            module = EdpRedyModule.from_json(module_json)
+            fetched_ids.add(module.pkid)
+            old_module = self.modules_dict.get(module.pkid)
+            if old_module is None:
+                self.added_ids.add(module.pkid)
+            elif not module.same_state(old_module):
+                self.updated_ids.add(module.pkid)
+            self.modules_dict[module.pkid] = module
+            # modules read from the local box get their samples from it
+            if "HA_POWER_METER" in module.capabilities and \
+                    module.pkid not in self._local_ids:
+                self._record_power(module.pkid, module.active_power)
+
+        # modules removed from the account: the entities see them missing
+        for pkid in set(self.modules_dict) - fetched_ids:
+            _LOGGER.debug("Module %s is gone", pkid)
+            del self.modules_dict[pkid]
+            self.power_stats.pop(pkid, None)
+            self.energy.pop(pkid, None)
+            self.updated_ids.add(pkid)
+            self.updated_ids.add(ENERGY_ID.format(pkid))
+
+        self._module_names = {module.name.strip().lower(): module.pkid
+                              for module in self.modules_dict.values()}
+        self._cloud_refresh_needed = False
+        return True
 
-        if modules_str is None:
-            return False
+    async def async_fetch_local(self):
+        """Fetch the power readings from the local box.
 
+        Returns the home power and the node readings, None on failure.
+        """
+        websession = self._websession or \
+            aiohttp_client.async_get_clientsession(self._hass)
         try:
-            updated_dict = json.loads(modules_str)
-        except (json.decoder.JSONDecodeError, TypeError):
-            _LOGGER.error("Error parsing modules json. Received: \n %s",
-                          modules_str)
-            return False
+            with async_timeout.timeout(LOCAL_TIMEOUT, loop=self._hass.loop):
+                resp = await websession.get(self._local_url)
+                body = await resp.read()
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            _LOGGER.debug("Local box not reachable at %s", self._local_url)
+            return None
 
-        if "Body" not in updated_dict:
-            return False
-        if "Modules" not in updated_dict["Body"]:
-            return False
+        if resp.status != 200:
+            _LOGGER.debug("Local box returned status code %s", resp.status)
+            return None
 
-        for module in updated_dict["Body"]["Modules"]:
-            self.modules_dict[module['PKID']] = module
+        try:
+            return _parse_local_readings(_extract_local_json(body))
+        except (ValueError, AttributeError, TypeError):
+            _LOGGER.debug("Could not parse the local box data")
+            return None
 
+    def _apply_local_readings(self, home_power, nodes):
+        """Use the local box readings as the power of the home and modules."""
+        self._local_ids = set()
+        if home_power is not None:
+            self._local_ids.add(ACTIVE_POWER_ID)
+            if self.values_dict.get(ACTIVE_POWER_ID) != home_power:
+                self.values_dict[ACTIVE_POWER_ID] = home_power
+                self.updated_ids.add(ACTIVE_POWER_ID)
+            self._record_power(ACTIVE_POWER_ID, home_power)
+
+        for node_id, (name, power) in nodes.items():
+            # nodes have the module PKID as id, or at least the same name
+            pkid = node_id if node_id in self.modules_dict \
+                else self._module_names.get(name.strip().lower())
+            if pkid is None or power is None:
+                continue
+
+            self._local_ids.add(pkid)
+            module = self.modules_dict[pkid]
+            if module.active_power != power:
+                module.state_vars[STATE_VAR_ACTIVE_POWER] = power
+                self.updated_ids.add(pkid)
+            if "HA_POWER_METER" in module.capabilities:
+                self._record_power(pkid, power)
+
+    def as_snapshot(self):
+        """Return the current data in a json serializable form."""
+        return {
+            'modules': [module.as_dict()
+                        for module in self.modules_dict.values()],
+            'values': self.values_dict,
+        }
+
+    def restore_snapshot(self, snapshot):
+        """Load the data saved by as_snapshot."""
+        try:
+            modules = [EdpRedyModule.from_dict(module)
+                       for module in snapshot['modules']]
+            values = dict(snapshot['values'])
+        except (KeyError, TypeError):
+            _LOGGER.warning("Ignoring invalid snapshot")
+            return False
+
+        self.modules_dict = {module.pkid: module for module in modules}
+        self.values_dict = values
+        self.restored = True
         return True
 
     async def async_update(self):
-        """Get data from the server and update local structures."""
-        modules_success = await self.async_fetch_modules()
-        active_power_success = await self.async_fetch_active_power()
-
-        return modules_success and active_power_success
+        """Get data from the server and update local structures.
+
+        The ids of the modules (and ACTIVE_POWER_ID) whose data changed or
+        that were removed are left in updated_ids, the ids of new modules
+        in added_ids.
+        """
+        self.updated_ids = set()
+        self.added_ids = set()
+
+        # the local box is fast and has the power readings: with it, the
+        # cloud is only needed now and then for the modules and relay states
+        readings = None
+        if self._local_url is not None:
+            readings = await self.async_fetch_local()
+
+        now = self._hass.loop.time()
+        fetch_modules = readings is None or self._modules_time is None or \
+            now - self._modules_time >= self._modules_refresh_interval()
+        fetches = []
+        if fetch_modules:
+            fetches.append(self.async_fetch_modules())
+        local_ids = self._local_ids
+        if readings is None:
+            self._local_ids = set()
+        # boxes without a smart meter (EDPBOX) have no home power
+        fetch_power = readings is None or readings[0] is None
+        if fetch_power:
+            fetches.append(self.async_fetch_active_power())
+        results = await asyncio.gather(*fetches)
+
+        if fetch_modules:
+            self._modules_time = now
+            self._modules_failures = 0 if results[0] \
+                else self._modules_failures + 1
+
+        if readings is not None:
+            # the readings are fresh even if the cloud refresh of the
+            # modules failed, that refresh is retried on the next update
+            self._apply_local_readings(*readings)
+            self.power_source = 'local'
+            success = results[-1] if fetch_power else True
+        else:
+            self.power_source = 'cloud'
+            success = all(results)
+
+        # the entities of these stay available or not with the server
+        for device_id in local_ids ^ self._local_ids:
+            self.updated_ids.add(device_id)
+            self.updated_ids.add(ENERGY_ID.format(device_id))
+
+        if success and self.restored:
+            # all entities must drop their restored flag
+            self.restored = False
+            self.updated_ids.update(self.modules_dict)
+            self.updated_ids.add(ACTIVE_POWER_ID)
+
+        return success
+
+    def _modules_refresh_interval(self):
+        """Return the seconds between module fetches while the box answers.
+
+        While the fetches fail, they back off so the box readings are not
+        held up by the cloud timeouts.
+        """
+        if self._modules_failures:
+            return min(LOCAL_CLOUD_REFRESH_INTERVAL,
+                       UPDATE_INTERVAL * 2 ** self._modules_failures)
+        if self._cloud_refresh_needed:
+            return 0
+        for module in self.modules_dict.values():
+            # relay states, and the power of the meters the box does not
+            # read, only come from the cloud
+            if "HA_SWITCH" in module.capabilities or \
+                    ("HA_POWER_METER" in module.capabilities and
+                     module.pkid not in self._local_ids):
+                return 0
+        return LOCAL_CLOUD_REFRESH_INTERVAL
 
     async def async_set_state_var(self, json_payload):
-        """Call SetStateVar API on the server."""
-        if not await self.async_validate_session():
-            return False
+        """Call SetStateVar API on the server.
 
-        _LOGGER.debug("Calling %s with: %s", URL_SET_STATE_VAR,
-                      str(json_payload))
+        Commands go through the command queue, so a burst of commands (e.g.
+        from a scene) is sent concurrently, with superseded ones dropped.
+        """
+        return await self._command_queue.async_send(json_payload)
 
-        try:
-            with async_timeout.timeout(DEFAULT_TIMEOUT, loop=self._hass.loop):
-                resp = await self._session.post(URL_SET_STATE_VAR,
-                                                json=json_payload)
-        except (asyncio.TimeoutError, aiohttp.ClientError):
-            _LOGGER.error("Error while setting state var")
-            return False
-        if resp.status != 200:
-            _LOGGER.error("Setting state var returned status code %s",
-                          resp.status)
+    async def _async_send_state_var(self, json_payload):
+        url = self._url(URL_SET_STATE_VAR)
+        _LOGGER.debug("Calling %s with: %s", url, str(json_payload))
+
+        body = await self._async_post(url, ENDPOINT_SET_STATE_VAR,
+                                      "setting state var", expect_json=False,
+                                      json=json_payload)
+        if body is None:
             return False
 
+        # the relay states come from the cloud
+        self._cloud_refresh_needed = True
+        if self.scheduler is not None:
+            self.scheduler.async_request_refresh()
         return True
 
 
-async def async_setup(hass, config):
-    """Set up the EDP re:dy component."""
-    session = EdpRedySession(hass, config[DOMAIN][CONF_USERNAME],
-                             config[DOMAIN][CONF_PASSWORD])
-    hass.data[EDP_REDY] = session
-    platform_loaded = False
+class EdpRedyScheduler:
+    """Schedule the updates of a session.
 
-    async def async_update_and_sched(time):
-        update_success = await session.async_update()
+    Updates are never run concurrently and each one is planned from the
+    planned time of the previous one, so the schedule does not drift. With
+    adaptive polling the interval shrinks while the home power is changing
+    fast and grows while it is flat. Failures back off exponentially.
+    """
 
-        if update_success:
-            dispatcher.async_dispatcher_send(hass, DATA_UPDATE_TOPIC)
+    def __init__(self, hass, session, update_method, adaptive,
+                 min_interval, max_interval, offset=0):
+        """Init the scheduler."""
+        self._hass = hass
+        self._session = session
+        self._update_method = update_method
+        self._adaptive = adaptive
+        self._min_interval = min(min_interval, max_interval)
+        self._max_interval = max(min_interval, max_interval)
+        self._interval = min(max(UPDATE_INTERVAL, self._min_interval),
+                             self._max_interval) \
+            if adaptive else UPDATE_INTERVAL
+        self._failures = 0
+        self._last_power = None
+        self._planned_time = None
+        self._unsub = None
+        self._running = False
+        self._refresh_pending = False
+        self._offset = offset
 
-            nonlocal platform_loaded
-            if not platform_loaded:
-                for component in ['sensor', 'switch']:
-                    await discovery.async_load_platform(hass, component,
-                                                        DOMAIN, {}, config)
-                platform_loaded = True
+    @property
+    def interval(self):
+        """Return the current update interval in seconds."""
+        return self._interval
+
+    @callback
+    def async_start(self):
+        """Run the first update after the start offset."""
+        self._schedule(dt_util.utcnow() + timedelta(seconds=self._offset))
+
+    @callback
+    def async_stop(self):
+        """Cancel the next update."""
+        if self._unsub is not None:
+            self._unsub()
+            self._unsub = None
+
+    @callback
+    def async_request_refresh(self):
+        """Run an update soon, then restart the schedule from it.
+
+        Requests made while a refresh is pending share that refresh.
+        """
+        if self._refresh_pending:
+            return
+
+        self._refresh_pending = True
+        if not self._running:
+            self._schedule(dt_util.utcnow() + timedelta(
+                seconds=COMMAND_REFRESH_DELAY))
+
+    @callback
+    def _schedule(self, point_in_time):
+        self.async_stop()
+        self._planned_time = point_in_time
+        self._unsub = async_track_point_in_time(
+            self._hass, self._async_run, point_in_time)
+
+    async def _async_run(self, now):
+        self._unsub = None
+        if self._running:
+            return
+
+        self._running = True
+        self._refresh_pending = False
+        try:
+            success = await self._update_method()
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Unexpected error while updating")
+            success = False
+        finally:
+            self._running = False
+
+        if self._refresh_pending:
+            # requested while running, the fetched data may predate it
+            self._schedule(dt_util.utcnow() + timedelta(
+                seconds=COMMAND_REFRESH_DELAY))
+            return
+
+        next_time = self._planned_time + timedelta(
+            seconds=self._next_delay(success))
+        # a cycle longer than the interval skips the missed updates
+        self._schedule(max(next_time, dt_util.utcnow()))
+
+    def _next_delay(self, success):
+        """Return the delay until the next update."""
+        if not success:
+            self._failures += 1
+            backoff = min(MAX_BACKOFF_INTERVAL,
+                          self._interval * 2 ** self._failures)
+            delay = random.uniform(backoff / 2, backoff)
+            _LOGGER.debug("Update failed %s times, retrying in %.0f s",
+                          self._failures, delay)
+            return delay
+
+        self._failures = 0
+        if self._adaptive:
+            self._adapt_interval()
+        return self._interval
+
+    def _adapt_interval(self):
+        """Adjust the interval to how fast the home power is changing."""
+        power = self._session.values_dict.get(ACTIVE_POWER_ID)
+        last_power, self._last_power = self._last_power, power
+        if power is None or last_power is None:
+            return
+
+        change = abs(power - last_power) / max(abs(last_power),
+                                               ADAPTIVE_MIN_POWER)
+        if change >= ADAPTIVE_POWER_CHANGE:
+            self._interval = max(self._min_interval, self._interval / 2)
+        else:
+            self._interval = min(self._max_interval, self._interval * 1.25)
 
-        # schedule next update
-        async_track_point_in_time(hass, async_update_and_sched,
-                                  time + timedelta(seconds=UPDATE_INTERVAL))
+
+async def async_setup(hass, config):
+    """Set up the EDP re:dy component."""
+    accounts = config[DOMAIN]
+    hass.data[EDP_REDY] = {}
+    schedulers = []
+
+    for index, account_config in enumerate(accounts):
+        # spread the updates of the accounts over the update interval
+        offset = index * UPDATE_INTERVAL / len(accounts)
+        schedulers.append(await _async_setup_account(hass, config,
+                                                     account_config, offset))
 
     async def start_component(event):
         _LOGGER.debug("Starting updates")
-        await async_update_and_sched(dt_util.utcnow())
+        for scheduler in schedulers:
+            scheduler.async_start()
+
+    async def stop_component(event):
+        for scheduler in schedulers:
+            scheduler.async_stop()
+        await asyncio.gather(*[session.async_logout() for session
+                               in hass.data[EDP_REDY].values()])
+
+    async def async_dump_stats(service):
+        for session in hass.data[EDP_REDY].values():
+            diagnostics = session.diagnostics()
+            _LOGGER.info("Statistics of %s: %s", session.account_id,
+                         json.dumps(diagnostics))
+            hass.bus.async_fire(EVENT_STATS, diagnostics)
+
+    hass.services.async_register(DOMAIN, SERVICE_DUMP_STATS,
+                                 async_dump_stats)
 
     # only start fetching data after HA boots to prevent delaying the boot
     # process
     hass.bus.async_listen_once(EVENT_HOMEASSISTANT_START, start_component)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, stop_component)
 
     return True
 
 
+async def _async_setup_account(hass, config, account_config, offset):
+    """Set up the session of an account and return its scheduler."""
+    # every account has its own cookie jar over the shared connection pool
+    session = EdpRedySession(
+        hass, account_config[CONF_USERNAME], account_config[CONF_PASSWORD],
+        account=account_config.get(CONF_NAME),
+        websession=aiohttp_client.async_create_clientsession(hass),
+        statistics_windows=account_config[CONF_STATISTICS_WINDOWS],
+        local_host=account_config.get(CONF_LOCAL_HOST),
+        max_update_interval=account_config[CONF_MAX_UPDATE_INTERVAL])
+    hass.data[EDP_REDY][session.account_id] = session
+    discovery_info = {CONF_ACCOUNT: session.account_id}
+    platform_loaded = False
+    store = Store(hass, STORAGE_VERSION,
+                  STORAGE_KEY if session.account is None
+                  else ACCOUNT_STORAGE_KEY.format(session.account_id))
+    energy_store = Store(
+        hass, STORAGE_VERSION,
+        ENERGY_STORAGE_KEY if session.account is None
+        else ACCOUNT_ENERGY_STORAGE_KEY.format(session.account_id))
+
+    async_save_snapshot = _delayed_saver(store, session.as_snapshot,
+                                         SNAPSHOT_SAVE_DELAY)
+    async_save_energy = _delayed_saver(energy_store, session.energy_snapshot,
+                                       ENERGY_SAVE_DELAY)
+
+    async def async_load_platforms():
+        for component in ['sensor', 'switch']:
+            await discovery.async_load_platform(hass, component, DOMAIN,
+                                                discovery_info, config)
+
+    async def async_update_data():
+        update_success = await session.async_update()
+
+        # changes are already in the session data even if part of the
+        # update failed, they would not be detected again on the next one
+        for device_id in session.updated_ids:
+            dispatcher.async_dispatcher_send(
+                hass, DATA_UPDATE_TOPIC.format(session.unique_id(device_id)))
+
+        if update_success:
+            async_save_snapshot()
+            async_save_energy()
+
+        # new modules are only reported once, the platforms loaded later
+        # create the entities of all the known modules
+        nonlocal platform_loaded
+        if platform_loaded:
+            if session.added_ids:
+                dispatcher.async_dispatcher_send(
+                    hass, NEW_MODULES_TOPIC.format(session.account_id),
+                    session.added_ids)
+        elif update_success:
+            await async_load_platforms()
+            platform_loaded = True
+
+        dispatcher.async_dispatcher_send(
+            hass, DATA_UPDATE_TOPIC.format(session.unique_id(DIAGNOSTICS_ID)))
+
+        return update_success
+
+    scheduler = EdpRedyScheduler(hass, session, async_update_data,
+                                 account_config[CONF_ADAPTIVE_POLLING],
+                                 account_config[CONF_MIN_UPDATE_INTERVAL],
+                                 account_config[CONF_MAX_UPDATE_INTERVAL],
+                                 offset)
+    session.scheduler = scheduler
+
+    energy = await energy_store.async_load()
+    if energy is not None:
+        session.restore_energy(energy)
+
+    # create the entities right away from the last known data, the first
+    # update replaces it
+    snapshot = await store.async_load()
+    if snapshot is not None and session.restore_snapshot(snapshot):
+        _LOGGER.debug("Restored %s modules from snapshot",
+                      len(session.modules_dict))
+        hass.async_create_task(async_load_platforms())
+        platform_loaded = True
+
+    return scheduler
+
+
 class EdpRedyDevice(Entity):
     """Representation a base re:dy device."""
 
@@ -291,13 +1541,34 @@ class EdpRedyDevice(Entity):
         self._is_available = True
         self._device_state_attributes = {}
         self._id = device_id
-        self._unique_id = device_id
-        self._name = name if len(name) > 0 else device_id
+        self._unique_id = session.unique_id(device_id)
+        name = name if len(name) > 0 else device_id
+        if session.account is not None:
+            name = "{0} {1}".format(session.account, name)
+        self._name = name
+        self._topic_id = self._unique_id
+        self._unsub_dispatcher = []
+        # power source of the entity: while the box reads it, the entity
+        # stays available when the server is not
+        self._local_source_id = None
 
     async def async_added_to_hass(self):
-        """Subscribe to the data updates topic."""
-        dispatcher.async_dispatcher_connect(
-            self.hass, DATA_UPDATE_TOPIC, self._data_updated)
+        """Subscribe to the data updates topic of this device."""
+        self._unsub_dispatcher = [
+            dispatcher.async_dispatcher_connect(
+                self.hass, DATA_UPDATE_TOPIC.format(self._topic_id),
+                self._data_updated),
+            dispatcher.async_dispatcher_connect(
+                self.hass,
+                AVAILABILITY_TOPIC.format(self._session.account_id),
+                self._availability_changed),
+        ]
+
+    async def async_will_remove_from_hass(self):
+        """Unsubscribe from the data updates topics."""
+        for unsub in self._unsub_dispatcher:
+            unsub()
+        self._unsub_dispatcher = []
 
     @property
     def name(self):
@@ -312,7 +1583,9 @@ class EdpRedyDevice(Entity):
     @property
     def available(self):
         """Return True if entity is available."""
-        return self._is_available
+        return self._is_available and (
+            self._session.available or
+            self._session.is_local(self._local_source_id))
 
     @property
     def should_poll(self):
@@ -322,19 +1595,30 @@ class EdpRedyDevice(Entity):
     @property
     def device_state_attributes(self):
         """Return the state attributes."""
+        if self._session.restored:
+            attrs = {ATTR_RESTORED: True}
+            attrs.update(self._device_state_attributes)
+            return attrs
         return self._device_state_attributes
 
     @callback
     def _data_updated(self):
         """Update state, trigger updates."""
-        self.async_schedule_update_ha_state(True)
+        self.async_schedule_update_ha_state()
 
-    def _parse_data(self, data):
-        """Parse data received from the server."""
-        if "OutOfOrder" in data:
-            try:
-                self._is_available = not data["OutOfOrder"]
-            except ValueError:
-                _LOGGER.error(
-                    "Could not parse OutOfOrder for %s", self._id)
-                self._is_available = False
+    @callback
+    def _availability_changed(self):
+        """Write the state when the server becomes (un)available."""
+        self.async_schedule_update_ha_state()
+
+    @callback
+    def _async_module_removed(self):
+        """Remove the entity of a module that is gone from the account."""
+        _LOGGER.info("Module %s was removed, removing %s", self._id,
+                     self.entity_id)
+        self._is_available = False
+        self.hass.async_create_task(self.async_remove())
+
+    def _parse_data(self, module):
+        """Parse the module data received from the server."""
+        self._is_available = not module.out_of_order
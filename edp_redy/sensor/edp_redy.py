@@ -1,37 +1,76 @@
 """Support for EDP re:dy sensors."""
 import logging
 
+from homeassistant.core import callback
+from homeassistant.helpers import dispatcher
 from homeassistant.helpers.entity import Entity
 
 try:
     from homeassistant.components.edp_redy import (EdpRedyDevice, EDP_REDY,
-                                                   ACTIVE_POWER_ID)
+                                                   ACTIVE_POWER_ID,
+                                                   NEW_MODULES_TOPIC,
+                                                   CONF_ACCOUNT,
+                                                   DIAGNOSTICS_ID, ENDPOINTS,
+                                                   ENERGY_ID)
 except ImportError:
     from custom_components.edp_redy import (EdpRedyDevice, EDP_REDY,
-                                            ACTIVE_POWER_ID)
+                                            ACTIVE_POWER_ID,
+                                            NEW_MODULES_TOPIC, CONF_ACCOUNT,
+                                            DIAGNOSTICS_ID, ENDPOINTS,
+                                            ENERGY_ID)
 
 _LOGGER = logging.getLogger(__name__)
 
 # Load power in watts (W)
 ATTR_ACTIVE_POWER = 'active_power'
+ATTR_LOGINS_LAST_HOUR = 'logins_last_hour'
 
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_devices,
+                               discovery_info=None):
     """Perform the setup for re:dy devices."""
-    session = hass.data[EDP_REDY]
-    devices = []
+    if discovery_info is None:
+        return
+    session = hass.data[EDP_REDY][discovery_info[CONF_ACCOUNT]]
 
-    """ Create sensors for modules """
-    for device_pkid, device_json in session.modules_dict.items():
-        if "HA_POWER_METER" not in device_json["Capabilities"]:
-            continue
-        devices.append(EdpRedyModuleSensor(session, device_json))
+    @callback
+    def async_add_modules(pkids):
+        """Create sensors for modules."""
+        devices = []
+        for pkid in pkids:
+            module = session.modules_dict.get(pkid)
+            if module is None or \
+                    "HA_POWER_METER" not in module.capabilities:
+                continue
+            devices.append(EdpRedyModuleSensor(session, module))
+            devices.append(EdpRedyEnergySensor(
+                session, module.pkid, "Energy {0}".format(module.name)))
+
+        if devices:
+            async_add_devices(devices)
+
+    async_add_modules(list(session.modules_dict))
+    dispatcher.async_dispatcher_connect(
+        hass, NEW_MODULES_TOPIC.format(session.account_id), async_add_modules)
 
     """ Create a sensor for global active power """
-    devices.append(EdpRedySensor(session, ACTIVE_POWER_ID, "Power Home",
-                                 "mdi:flash", "W"))
+    devices = [EdpRedySensor(session, ACTIVE_POWER_ID, "Power Home",
+                             "mdi:flash", "W"),
+               EdpRedyEnergySensor(session, ACTIVE_POWER_ID, "Energy Home")]
+
+    """ Create diagnostic sensors for the connection to the server """
+    devices.extend(EdpRedyLatencySensor(session, endpoint)
+                   for endpoint in ENDPOINTS)
+    devices.append(EdpRedySessionSensor(session))
 
-    add_devices(devices)
+    async_add_devices(devices)
+
+
+def _update_power_stats(session, device_id, attributes):
+    """Set the rolling power statistics of a device in its attributes."""
+    stats = session.power_stats.get(device_id)
+    if stats is not None:
+        attributes.update(stats.as_attributes())
 
 
 class EdpRedySensor(EdpRedyDevice, Entity):
@@ -41,6 +80,7 @@ class EdpRedySensor(EdpRedyDevice, Entity):
         """Initialize the sensor."""
         EdpRedyDevice.__init__(self, session, sensor_id, name)
 
+        self._local_source_id = sensor_id
         self._icon = icon
         self._unit = unit
 
@@ -72,16 +112,24 @@ class EdpRedySensor(EdpRedyDevice, Entity):
         else:
             self._is_available = False
 
+        if self._id == ACTIVE_POWER_ID:
+            self._device_state_attributes[ATTR_LOGINS_LAST_HOUR] = \
+                self._session.logins_last_hour
+
+        _update_power_stats(self._session, self._id,
+                            self._device_state_attributes)
+
 
 class EdpRedyModuleSensor(EdpRedyDevice, Entity):
     """Representation of a EDP re:dy module sensor."""
 
-    def __init__(self, session, device_json):
+    def __init__(self, session, module):
         """Initialize the sensor."""
-        EdpRedyDevice.__init__(self, session, device_json['PKID'],
-                               "Power {0}".format(device_json['Name']))
+        EdpRedyDevice.__init__(self, session, module.pkid,
+                               "Power {0}".format(module.name))
 
-        self._parse_data(device_json)
+        self._local_source_id = module.pkid
+        self._parse_data(module)
 
     @property
     def state(self):
@@ -99,25 +147,150 @@ class EdpRedyModuleSensor(EdpRedyDevice, Entity):
         return 'W'
 
     def _data_updated(self):
-        if self._id in self._session.modules_dict:
-            device_json = self._session.modules_dict[self._id]
-            self._parse_data(device_json)
-        else:
+        if self._id not in self._session.modules_dict:
+            self._async_module_removed()
+            return
+
+        self._parse_data(self._session.modules_dict[self._id])
+        super()._data_updated()
+
+    def _parse_data(self, module):
+        """Parse the module data received from the server."""
+        super()._parse_data(module)
+
+        _LOGGER.debug("Sensor data: %s", module)
+
+        self._state = module.active_power
+        if self._state is None:
             self._is_available = False
 
+        _update_power_stats(self._session, self._id,
+                            self._device_state_attributes)
+
+
+class EdpRedyEnergySensor(EdpRedyDevice, Entity):
+    """Energy consumed by a power source, integrated from its samples."""
+
+    def __init__(self, session, source_id, name):
+        """Initialize the sensor."""
+        EdpRedyDevice.__init__(self, session, ENERGY_ID.format(source_id),
+                               name)
+
+        self._source_id = source_id
+        self._local_source_id = source_id
+        self._update_state()
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend."""
+        return "mdi:counter"
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement of this sensor."""
+        return 'kWh'
+
+    def _data_updated(self):
+        if self._source_id != ACTIVE_POWER_ID and \
+                self._source_id not in self._session.modules_dict:
+            self._async_module_removed()
+            return
+
+        self._update_state()
         super()._data_updated()
 
-    def _parse_data(self, data):
-        """Parse data received from the server."""
-        super()._parse_data(data)
+    def _update_state(self):
+        integrator = self._session.energy.get(self._source_id)
+        self._state = round(integrator.total, 3) \
+            if integrator is not None else 0.0
+
+
+class EdpRedyLatencySensor(EdpRedyDevice, Entity):
+    """Diagnostic sensor with the latency and errors of an endpoint."""
 
-        _LOGGER.debug("Sensor data: " + str(data))
+    def __init__(self, session, endpoint):
+        """Initialize the sensor."""
+        EdpRedyDevice.__init__(self, session,
+                               "{0}_latency".format(endpoint.lower()),
+                               "re:dy {0} latency".format(endpoint))
 
-        for state_var in data["StateVars"]:
-            if state_var["Name"] == "ActivePower":
-                try:
-                    self._state = float(state_var["Value"]) * 1000
-                except ValueError:
-                    _LOGGER.error("Could not parse power for %s", self._id)
-                    self._state = 0
-                    self._is_available = False
+        self._endpoint = endpoint
+        self._topic_id = session.unique_id(DIAGNOSTICS_ID)
+        self._update_state()
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state
+
+    @property
+    def available(self):
+        """Return True, diagnostics matter most when the server is down."""
+        return True
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend."""
+        return "mdi:timer"
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement of this sensor."""
+        return 'ms'
+
+    def _data_updated(self):
+        self._update_state()
+        super()._data_updated()
+
+    def _update_state(self):
+        stats = self._session.stats[self._endpoint]
+        mean = stats.latency_mean
+        self._state = round(mean * 1000) if mean is not None else None
+        self._device_state_attributes = stats.as_dict()
+
+
+class EdpRedySessionSensor(EdpRedyDevice, Entity):
+    """Diagnostic sensor with the age of the session to the server."""
+
+    def __init__(self, session):
+        """Initialize the sensor."""
+        EdpRedyDevice.__init__(self, session, "session_age",
+                               "re:dy session age")
+
+        self._topic_id = session.unique_id(DIAGNOSTICS_ID)
+        self._update_state()
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state
+
+    @property
+    def available(self):
+        """Return True, diagnostics matter most when the server is down."""
+        return True
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend."""
+        return "mdi:account-clock"
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement of this sensor."""
+        return 's'
+
+    def _data_updated(self):
+        self._update_state()
+        super()._data_updated()
+
+    def _update_state(self):
+        age = self._session.session_age
+        self._state = round(age) if age is not None else None
+        self._device_state_attributes[ATTR_LOGINS_LAST_HOUR] = \
+            self._session.logins_last_hour
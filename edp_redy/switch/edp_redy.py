@@ -2,11 +2,16 @@
 import logging
 
 try:
-    from homeassistant.components.edp_redy import EdpRedyDevice, EDP_REDY
+    from homeassistant.components.edp_redy import (EdpRedyDevice, EDP_REDY,
+                                                   NEW_MODULES_TOPIC,
+                                                   CONF_ACCOUNT)
 except ImportError:
-    from custom_components.edp_redy import EdpRedyDevice, EDP_REDY
+    from custom_components.edp_redy import (EdpRedyDevice, EDP_REDY,
+                                            NEW_MODULES_TOPIC, CONF_ACCOUNT)
 
 from homeassistant.components.switch import SwitchDevice
+from homeassistant.core import callback
+from homeassistant.helpers import dispatcher
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -14,29 +19,41 @@ _LOGGER = logging.getLogger(__name__)
 ATTR_ACTIVE_POWER = 'active_power'
 
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_devices,
+                               discovery_info=None):
     """Perform the setup for re:dy devices."""
-    session = hass.data[EDP_REDY]
-    devices = []
-    for device_pkid, device_json in session.modules_dict.items():
-        if "HA_SWITCH" not in device_json["Capabilities"]:
-            continue
-        devices.append(EdpRedySwitch(session, device_json))
+    if discovery_info is None:
+        return
+    session = hass.data[EDP_REDY][discovery_info[CONF_ACCOUNT]]
 
-    add_devices(devices)
+    @callback
+    def async_add_modules(pkids):
+        """Create switches for modules."""
+        devices = []
+        for pkid in pkids:
+            module = session.modules_dict.get(pkid)
+            if module is None or "HA_SWITCH" not in module.capabilities:
+                continue
+            devices.append(EdpRedySwitch(session, module))
+
+        if devices:
+            async_add_devices(devices)
+
+    async_add_modules(list(session.modules_dict))
+    dispatcher.async_dispatcher_connect(
+        hass, NEW_MODULES_TOPIC.format(session.account_id), async_add_modules)
 
 
 class EdpRedySwitch(EdpRedyDevice, SwitchDevice):
     """Representation of a Edp re:dy switch (plugs, switches, etc)."""
 
-    def __init__(self, session, device_json):
+    def __init__(self, session, module):
         """Initialize the switch."""
-        EdpRedyDevice.__init__(self, session, device_json['PKID'],
-                               device_json['Name'])
+        EdpRedyDevice.__init__(self, session, module.pkid, module.name)
 
         self._active_power = None
 
-        self._parse_data(device_json)
+        self._parse_data(module)
 
     @property
     def icon(self):
@@ -76,25 +93,17 @@ class EdpRedySwitch(EdpRedyDevice, SwitchDevice):
         return await self._session.async_set_state_var(state_json)
 
     def _data_updated(self):
-        if self._id in self._session.modules_dict:
-            device_json = self._session.modules_dict[self._id]
-            self._parse_data(device_json)
-        else:
-            self._is_available = False
+        if self._id not in self._session.modules_dict:
+            self._async_module_removed()
+            return
 
+        self._parse_data(self._session.modules_dict[self._id])
         super()._data_updated()
 
-    def _parse_data(self, data):
-        """Parse data received from the server."""
-        super()._parse_data(data)
-
-        for state_var in data["StateVars"]:
-            if state_var["Name"] == "RelayState":
-                self._state = True if state_var["Value"] == "true" \
-                    else False
-            elif state_var["Name"] == "ActivePower":
-                try:
-                    self._active_power = float(state_var["Value"]) * 1000
-                except ValueError:
-                    _LOGGER.error("Could not parse power for %s", self._id)
-                    self._active_power = None
+    def _parse_data(self, module):
+        """Parse the module data received from the server."""
+        super()._parse_data(module)
+
+        if module.relay_state is not None:
+            self._state = module.relay_state
+        self._active_power = module.active_power
@@ -0,0 +1,147 @@
+"""
+Parsing of the /api/devices page of an EDP re:dy box.
+
+Kept free of Home Assistant imports, so captured pages can be replayed and
+the parsing benchmarked on their own (see benchmarks/edp_redy_local).
+"""
+import json
+from collections import namedtuple
+from html import unescape
+
+# the devices page embeds the json in a text node containing this key
+DEVICES_JSON_MARKER = b'REDYMETER'
+# device types whose nodes are meters
+NODE_DEVICE_TYPES = ('REDYMETER', 'ZBENDPOINT')
+SMART_METER_NAME = 'Smart Meter'
+
+# the fields a node can report: key in the node json and scale from the
+# unit of the box (kW, kWh, V, A) to the one of the readings (W, kWh, V, A)
+Field = namedtuple('Field', ['key', 'scale'])
+FIELD_POWER = 'power'
+FIELD_POWER_EXPORT = 'power_export'
+FIELD_ENERGY_TOTAL = 'energy_total'
+FIELD_ENERGY_EXPORT_TOTAL = 'energy_export_total'
+FIELD_VOLTAGE = 'voltage'
+FIELD_CURRENT = 'current'
+FIELDS = {
+    FIELD_POWER: Field('EMETER:POWER_APLUS', 1000),
+    FIELD_POWER_EXPORT: Field('EMETER:POWER_AMINUS', 1000),
+    FIELD_ENERGY_TOTAL: Field('EMETER:ENERGY_APLUS', 1),
+    FIELD_ENERGY_EXPORT_TOTAL: Field('EMETER:ENERGY_AMINUS', 1),
+    FIELD_VOLTAGE: Field('EMETER:VOLTAGE_L1', 1),
+    FIELD_CURRENT: Field('EMETER:CURRENT_L1', 1),
+}
+DEFAULT_FIELDS = (FIELD_POWER,)
+
+# values holds the decoded fields, in the order they were asked for, None
+# for the ones missing or unreadable
+NodeReading = namedtuple('NodeReading',
+                         ['node_id', 'name', 'last_communication', 'values'])
+
+
+def extract_devices_json(data):
+    """Return the devices json from the bytes of the /api/devices page.
+
+    The box either serves the json as is or embeds it in an html page. In
+    the latter case only the text node holding DEVICES_JSON_MARKER is
+    decoded and parsed, the rest of the page is not looked at.
+    """
+    if data[:64].lstrip()[:1] == b'{':
+        return json.loads(data.decode('utf-8'))
+
+    marker = data.find(DEVICES_JSON_MARKER)
+    if marker == -1:
+        raise ValueError("No devices json in the page")
+
+    # the text node starts after the tag before the marker and ends at the
+    # next tag, like the text handed out by an html parser
+    tag = data.rfind(b'<', 0, marker)
+    start = data.find(b'>', tag, marker) + 1 if tag != -1 else 0
+    start = data.find(b'{', start, marker)
+    if start == -1:
+        raise ValueError("No devices json in the page")
+    end = data.find(b'<', marker)
+    if end == -1:
+        end = len(data)
+
+    text = data[start:end].decode('utf-8')
+    if '&' in text:
+        text = unescape(text)
+    return json.JSONDecoder().raw_decode(text)[0]
+
+
+def _decode_values(node, fields):
+    """Return the values of the fields of a node, None if it has none."""
+    values = []
+    found = False
+    for key, scale in fields:
+        raw = node.get(key)
+        if raw is None:
+            values.append(None)
+            continue
+        found = True
+        try:
+            values.append(float(raw) * scale)
+        except (TypeError, ValueError):
+            values.append(None)
+    return tuple(values) if found else None
+
+
+def parse_devices(devices, fields=DEFAULT_FIELDS):
+    """Return the NodeReading of every meter in the devices json.
+
+    Only the keys of the given fields are looked at. Nodes without an id, a
+    name or any of the fields are skipped. The smart meter of the box, if
+    any, comes last.
+    """
+    if not isinstance(devices, dict):
+        raise ValueError("Devices json is not an object")
+
+    fields = [FIELDS[field] for field in fields]
+    readings = []
+    for device_type in NODE_DEVICE_TYPES:
+        for device in devices.get(device_type) or ():
+            for node in device.get('NODES') or ():
+                if 'ID' not in node or 'NAME' not in node:
+                    continue
+                values = _decode_values(node, fields)
+                if values is not None:
+                    readings.append(NodeReading(
+                        node['ID'], node['NAME'], None, values))
+
+    edp_box = devices.get('EDPBOX')
+    if edp_box and 'SMARTMETER_ID' in edp_box[0]:
+        edp_box = edp_box[0]
+        readings.append(NodeReading(
+            edp_box['SMARTMETER_ID'], SMART_METER_NAME,
+            edp_box.get('LAST_COMMUNICATION'),
+            _decode_values(edp_box, fields) or (None,) * len(fields)))
+
+    return readings
+
+
+class NodeReconciler:
+    """Keep one object per node of a box, poll after poll.
+
+    create(reading) builds the object of a node seen for the first time,
+    update(obj, reading) refreshes the object of a known node.
+    """
+
+    def __init__(self, create, update):
+        """Init the reconciler."""
+        self.nodes = {}
+        self._create = create
+        self._update = update
+
+    def reconcile(self, readings):
+        """Apply the readings of a poll, return the objects created."""
+        created = []
+        nodes = self.nodes
+        for reading in readings:
+            obj = nodes.get(reading.node_id)
+            if obj is None:
+                obj = nodes[reading.node_id] = self._create(reading)
+                created.append(obj)
+            else:
+                self._update(obj, reading)
+        return created
@@ -5,25 +5,29 @@
 import aiohttp
 import asyncio
 import async_timeout
-import json
 import logging
-from datetime import timedelta
+import time
+from collections import deque, OrderedDict
 
 import voluptuous as vol
 
 from homeassistant.core import callback
-from homeassistant.const import (ATTR_FRIENDLY_NAME, CONF_HOST,
-                                 EVENT_HOMEASSISTANT_START, STATE_UNKNOWN)
+from homeassistant.const import (ATTR_FRIENDLY_NAME, CONF_HOST, CONF_HOSTS,
+                                 CONF_TIMEOUT, EVENT_HOMEASSISTANT_START,
+                                 EVENT_HOMEASSISTANT_STOP, STATE_UNKNOWN)
 import homeassistant.helpers.config_validation as cv
-from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.entity import Entity, async_generate_entity_id
 from homeassistant.helpers.event import (async_track_state_change,
                                          async_track_point_in_time)
 from homeassistant.helpers.config_validation import PLATFORM_SCHEMA
 from homeassistant.helpers import template as template_helper
-from homeassistant.util import dt as dt_util
+from homeassistant.helpers.storage import Store
+from homeassistant.util import dt as dt_util, slugify
 
-from html.parser import HTMLParser
+from .parser import (extract_devices_json, parse_devices, NodeReconciler,
+                     FIELDS, FIELD_POWER, FIELD_POWER_EXPORT,
+                     FIELD_ENERGY_TOTAL, FIELD_ENERGY_EXPORT_TOTAL,
+                     FIELD_VOLTAGE, FIELD_CURRENT)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -31,150 +35,599 @@ DOMAIN = 'edp_redy_local'
 ATTR_LAST_COMMUNICATION = 'last_communication'
 CONF_UPDATE_INTERVAL = 'update_interval'
 DEFAULT_TIMEOUT = 10
-
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
+# the box is on the lan, readings can be taken every second
+MIN_UPDATE_INTERVAL = 0.5
+DEFAULT_UPDATE_INTERVAL = 30
+# seconds an idle connection to a box is kept open, longer than the
+# default interval so connections survive between polls
+KEEPALIVE_TIMEOUT = 60
+# seconds of samples the achieved sample rate is computed over
+SAMPLE_RATE_WINDOW = 60
+ATTR_TARGET_RATE = 'target_rate'
+ATTR_SKIPPED_TICKS = 'skipped_ticks'
+ATTR_MISSED_TICKS = 'missed_ticks'
+ATTR_FAILED_REQUESTS = 'failed_requests'
+ATTR_LAST_DURATION = 'last_duration_ms'
+ATTR_RESPONDING = 'responding'
+
+# power changes smaller than the deadbands are not written to the state
+CONF_DEADBAND = 'deadband'
+CONF_DEADBAND_RELATIVE = 'deadband_relative'
+CONF_MIN_WRITE_INTERVAL = 'min_write_interval'
+CONF_HEARTBEAT_INTERVAL = 'heartbeat_interval'
+DEFAULT_HEARTBEAT_INTERVAL = 10
+
+# fields of the nodes exposed as sensors, besides the power
+CONF_FIELDS = 'fields'
+DEFAULT_FIELDS = [FIELD_POWER]
+# name format, unit and icon of the sensor of each field
+FIELD_SENSORS = {
+    FIELD_POWER: ('Power {0}', 'W', 'mdi:flash'),
+    FIELD_POWER_EXPORT: ('Export power {0}', 'W', 'mdi:transmission-tower'),
+    FIELD_ENERGY_TOTAL: ('Energy total {0}', 'kWh', 'mdi:counter'),
+    FIELD_ENERGY_EXPORT_TOTAL: ('Export energy total {0}', 'kWh',
+                                'mdi:counter'),
+    FIELD_VOLTAGE: ('Voltage {0}', 'V', 'mdi:sine-wave'),
+    FIELD_CURRENT: ('Current {0}', 'A', 'mdi:current-ac'),
+}
+# the deadband in W only applies to these
+POWER_FIELDS = (FIELD_POWER, FIELD_POWER_EXPORT)
+# cumulative counters of the box, written on any change
+COUNTER_FIELDS = (FIELD_ENERGY_TOTAL, FIELD_ENERGY_EXPORT_TOTAL)
+
+# energy totals integrated from the power samples, per box
+ENERGY_STORAGE_KEY = '{0}_energy_{{0}}'.format(DOMAIN)
+ENERGY_STORAGE_VERSION = 1
+ENERGY_SAVE_DELAY = 60
+# samples further apart (in seconds) are not integrated, raised for the
+# boxes polled less often
+MAX_INTEGRATION_GAP = 600
+
+UPDATE_INTERVAL_SCHEMA = vol.All(vol.Coerce(float),
+                                 vol.Range(min=MIN_UPDATE_INTERVAL))
+TIMEOUT_SCHEMA = vol.All(vol.Coerce(float), vol.Range(min=0.1))
+
+# a box is its host, or a dict overriding the interval and timeout
+BOX_SCHEMA = vol.Any(vol.Schema({
     vol.Required(CONF_HOST): cv.string,
-    vol.Optional(CONF_UPDATE_INTERVAL, default=30): cv.positive_int,
-})
+    vol.Optional(CONF_UPDATE_INTERVAL): UPDATE_INTERVAL_SCHEMA,
+    vol.Optional(CONF_TIMEOUT): TIMEOUT_SCHEMA,
+}), cv.string)
+
+PLATFORM_SCHEMA = vol.All(PLATFORM_SCHEMA.extend({
+    vol.Optional(CONF_HOST): cv.string,
+    vol.Optional(CONF_HOSTS): vol.All(cv.ensure_list, [BOX_SCHEMA]),
+    vol.Optional(CONF_UPDATE_INTERVAL, default=DEFAULT_UPDATE_INTERVAL):
+        UPDATE_INTERVAL_SCHEMA,
+    vol.Optional(CONF_TIMEOUT, default=DEFAULT_TIMEOUT): TIMEOUT_SCHEMA,
+    vol.Optional(CONF_DEADBAND, default=0):
+        vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_DEADBAND_RELATIVE, default=0):
+        vol.All(vol.Coerce(float), vol.Range(min=0, max=100)),
+    vol.Optional(CONF_MIN_WRITE_INTERVAL, default=0):
+        vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_HEARTBEAT_INTERVAL, default=DEFAULT_HEARTBEAT_INTERVAL):
+        vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_FIELDS, default=DEFAULT_FIELDS):
+        vol.All(cv.ensure_list, vol.Length(min=1), [vol.In(FIELDS)]),
+}), cv.has_at_least_one_key(CONF_HOST, CONF_HOSTS))
+
+
+def _box_configs(config):
+    """Return the config of each box, with the platform defaults."""
+    boxes = list(config.get(CONF_HOSTS, []))
+    if CONF_HOST in config:
+        boxes.insert(0, config[CONF_HOST])
+
+    for box in boxes:
+        if not isinstance(box, dict):
+            box = {CONF_HOST: box}
+        yield {
+            CONF_HOST: box[CONF_HOST],
+            CONF_UPDATE_INTERVAL: box.get(CONF_UPDATE_INTERVAL,
+                                          config[CONF_UPDATE_INTERVAL]),
+            CONF_TIMEOUT: box.get(CONF_TIMEOUT, config[CONF_TIMEOUT]),
+        }
 
 
 @asyncio.coroutine
 def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
-    class RedyHTMLParser(HTMLParser):
-        def __init__(self):
-            super().__init__()
-            self._json = ''
+    # a single poller and connection pool for the boxes of all platforms
+    poller = hass.data.get(DOMAIN)
+    if poller is None:
+        poller = hass.data[DOMAIN] = EdpRedyLocalPoller(hass)
+
+    fields = list(OrderedDict.fromkeys(config[CONF_FIELDS]))
+    relative = config[CONF_DEADBAND_RELATIVE] / 100
+    min_interval = config[CONF_MIN_WRITE_INTERVAL]
+    heartbeat = config[CONF_HEARTBEAT_INTERVAL] * 60
+    power_filter = EdpRedyLocalWriteFilter(
+        config[CONF_DEADBAND], relative, min_interval, heartbeat)
+    counter_filter = EdpRedyLocalWriteFilter(0, 0, min_interval, heartbeat)
+    other_filter = EdpRedyLocalWriteFilter(
+        0, relative, min_interval, heartbeat)
+    write_filters = [
+        power_filter if field in POWER_FIELDS
+        else counter_filter if field in COUNTER_FIELDS else other_filter
+        for field in fields]
+
+    for box_config in _box_configs(config):
+        if box_config[CONF_HOST] in poller.boxes:
+            _LOGGER.error("Redy box %s is configured more than once",
+                          box_config[CONF_HOST])
+            continue
+        yield from _async_setup_box(hass, poller, box_config, fields,
+                                    write_filters, async_add_entities)
 
-        def handle_data(self, data):
-            if data.find('REDYMETER') != -1:
-                self._json = data
 
-        def json(self):
-            return self._json
+@asyncio.coroutine
+def _async_setup_box(hass, poller, box_config, fields, write_filters,
+                     async_add_entities):
+    """Set up the sensors of a box and add it to the poller."""
+    host = box_config[CONF_HOST]
+
+    energy_store = Store(hass, ENERGY_STORAGE_VERSION,
+                         ENERGY_STORAGE_KEY.format(slugify(host)))
+    integrators = {}
+    stored_energy = yield from energy_store.async_load()
+    if stored_energy:
+        try:
+            for node_id, values in stored_energy.items():
+                integrators[node_id] = EnergyIntegrator(*values)
+        except (AttributeError, TypeError):
+            _LOGGER.warning("Ignoring invalid energy totals of %s", host)
+            integrators.clear()
+
+    # async_delay_save restarts its timer on every call, polls are more
+    # frequent than the delay: only call it when no save is pending
+    energy_save_pending = False
+
+    def energy_snapshot():
+        nonlocal energy_save_pending
+        energy_save_pending = False
+        return {node_id: integrator.as_list()
+                for node_id, integrator in integrators.items()}
+
+    # the energy is integrated when the power is read, a sample lost to a
+    # failed poll must not stop the integration
+    power_index = fields.index(FIELD_POWER) \
+        if FIELD_POWER in fields else None
+    integration_gap = max(
+        MAX_INTEGRATION_GAP,
+        2 * box_config[CONF_UPDATE_INTERVAL] + box_config[CONF_TIMEOUT])
+
+    def add_energy(reading):
+        integrator = integrators.get(reading.node_id)
+        if integrator is None:
+            integrator = integrators[reading.node_id] = EnergyIntegrator()
+        integrator.add(dt_util.utcnow().timestamp(),
+                       reading.values[power_index], integration_gap)
+        return integrator
+
+    # sensors created while parsing a page, added once it is parsed
+    new_sensors = []
+
+    def create_sensors(reading):
+        # one slot per field and one for the energy, None until the node
+        # reports a value for the field
+        node_sensors = [None] * (len(fields) + 1)
+        update_sensors(node_sensors, reading)
+        return node_sensors
+
+    def update_sensors(node_sensors, reading):
+        for index, value in enumerate(reading.values):
+            sensor = node_sensors[index]
+            if sensor is not None:
+                sensor.update_data(value, reading.last_communication)
+            elif value is not None:
+                node_sensors[index] = sensor = EdpRedyLocalSensor(
+                    reading.node_id, reading.name, fields[index], value,
+                    reading.last_communication, write_filters[index], box)
+                new_sensors.append(sensor)
+
+        if power_index is not None:
+            integrator = add_energy(reading)
+            if node_sensors[-1] is not None:
+                node_sensors[-1].update_data()
+            elif node_sensors[power_index] is not None:
+                node_sensors[-1] = sensor = EdpRedyLocalEnergySensor(
+                    reading.node_id, reading.name, integrator, box)
+                new_sensors.append(sensor)
+
+    reconciler = NodeReconciler(create_sensors, update_sensors)
+
+    @callback
+    def handle_data(data):
+        """Update the sensors from the devices page of the box."""
+        nonlocal energy_save_pending
+        try:
+            reconciler.reconcile(
+                parse_devices(extract_devices_json(data), fields))
+            if new_sensors:
+                async_add_entities(list(new_sensors))
+                del new_sensors[:]
 
-    host = config[CONF_HOST]
-    url = 'http://{}:1234/api/devices'.format(host)
+            if not energy_save_pending:
+                energy_save_pending = True
+                energy_store.async_delay_save(energy_snapshot,
+                                              ENERGY_SAVE_DELAY)
 
-    sensors = {}
-    new_sensors_list = []
+        except Exception as error:
+            _LOGGER.error("Failed to load data from redy box: %s", error)
+            return False
+
+        return True
+
+    @callback
+    def health_changed():
+        for node_sensors in reconciler.nodes.values():
+            for sensor in node_sensors:
+                if sensor is not None and sensor.hass is not None:
+                    sensor.async_schedule_update_ha_state()
+
+    box = poller.async_add_box(host, box_config[CONF_UPDATE_INTERVAL],
+                               box_config[CONF_TIMEOUT], handle_data)
+    box.async_add_health_listener(health_changed)
+    async_add_entities([EdpRedyLocalSampleRateSensor(box)])
+
+
+class EdpRedyLocalPoller:
+    """Poll the configured redy boxes through a shared connection pool.
+
+    Each box runs on its own schedule with its own timeout, so a dead box
+    only delays itself. Polling starts with Home Assistant and the pool is
+    closed when it stops.
+    """
+
+    def __init__(self, hass):
+        """Init the poller."""
+        self._hass = hass
+        self.boxes = {}
+        self._started = False
+        # one kept-alive connection per box, polls of a box never overlap
+        self.websession = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=0, limit_per_host=1,
+                keepalive_timeout=KEEPALIVE_TIMEOUT, loop=hass.loop),
+            loop=hass.loop)
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_START,
+                                   self._async_start)
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, self.async_stop)
+
+    @callback
+    def async_add_box(self, host, interval, timeout, data_method):
+        """Poll a box, data_method is called with each devices page."""
+        box = EdpRedyLocalBox(self._hass, self.websession, host, interval,
+                              timeout, data_method)
+        self.boxes[host] = box
+        if self._started:
+            box.async_start()
+        return box
+
+    @callback
+    def _async_start(self, event):
+        _LOGGER.debug("Starting updates")
+        self._started = True
+        for box in self.boxes.values():
+            box.async_start()
+
+    async def async_stop(self, event=None):
+        """Stop polling and close the connections to the boxes."""
+        self._started = False
+        for box in self.boxes.values():
+            box.async_stop()
+        await self.websession.close()
+
+
+class EdpRedyLocalBox:
+    """Poll a redy box on a fixed, drift-free schedule.
+
+    Ticks are planned on the loop's monotonic clock, each one interval
+    after the planned time of the previous one, whatever the requests take.
+    A tick that comes while the previous request is still in flight is
+    skipped instead of piling up requests on the box. The box is not
+    available while its requests fail.
+    """
+
+    def __init__(self, hass, websession, host, interval, timeout,
+                 data_method):
+        """Init the box, the interval and timeout are in seconds."""
+        self._hass = hass
+        self._websession = websession
+        self.host = host
+        self.url = 'http://{}:1234/api/devices'.format(host)
+        self.interval = interval
+        self.timeout = timeout
+        self._data_method = data_method
+        self._planned_time = None
+        self._handle = None
+        self._task = None
+        self._listeners = []
+        self._health_listeners = []
+        # monotonic times of the successful samples in SAMPLE_RATE_WINDOW
+        self._samples = deque()
+        self.skipped_ticks = 0
+        self.missed_ticks = 0
+        self.failed_requests = 0
+        self.last_duration = None
+        self.available = True
 
-    def load_sensor(sensor_id, name, power, last_communication):
-        if sensor_id in sensors:
-            sensors[sensor_id].update_data(power, last_communication)
+    @property
+    def sample_rate(self):
+        """Return the achieved samples per second, None if unknown."""
+        if len(self._samples) < 2:
+            return None
+        span = self._samples[-1] - self._samples[0]
+        return (len(self._samples) - 1) / span if span > 0 else None
+
+    @callback
+    def async_add_listener(self, update_callback):
+        """Call update_callback after every request."""
+        self._listeners.append(update_callback)
+
+    @callback
+    def async_add_health_listener(self, health_callback):
+        """Call health_callback when the box stops or starts responding."""
+        self._health_listeners.append(health_callback)
+
+    @callback
+    def async_start(self):
+        """Poll now and then every interval."""
+        self._planned_time = self._hass.loop.time()
+        self._tick()
+
+    @callback
+    def async_stop(self):
+        """Stop polling."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _async_fetch(self):
+        """Fetch the devices page and hand it to the data method."""
+        try:
+            with async_timeout.timeout(self.timeout, loop=self._hass.loop):
+                resp = await self._websession.get(self.url)
+                if resp.status != 200:
+                    _LOGGER.debug("%s answered %s", self.url, resp.status)
+                    resp.release()
+                    return False
+                data = await resp.read()
+
+        except (asyncio.TimeoutError, aiohttp.ClientError) as error:
+            _LOGGER.debug("Error while accessing %s: %s", self.url, error)
+            return False
+
+        return self._data_method(data)
+
+    @callback
+    def _tick(self):
+        # plan the next tick from this one's planned time, not from now
+        loop = self._hass.loop
+        self._planned_time += self.interval
+        late = loop.time() - self._planned_time
+        if late >= 0:
+            # the loop was blocked past whole ticks, drop them
+            missed = int(late // self.interval) + 1
+            self.missed_ticks += missed
+            self._planned_time += missed * self.interval
+        self._handle = loop.call_at(self._planned_time, self._tick)
+
+        if self._task is not None and not self._task.done():
+            self.skipped_ticks += 1
             return
+        self._task = self._hass.async_create_task(self._async_run())
+
+    async def _async_run(self):
+        start = self._hass.loop.time()
+        try:
+            success = await self._async_fetch()
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Unexpected error while polling %s", self.host)
+            success = False
+
+        now = self._hass.loop.time()
+        self.last_duration = now - start
+        if success:
+            self._samples.append(now)
+        else:
+            self.failed_requests += 1
+
+        while self._samples and \
+                now - self._samples[0] > SAMPLE_RATE_WINDOW:
+            self._samples.popleft()
+
+        if success != self.available:
+            # logged once, not on every tick of a dead box
+            self.available = success
+            if success:
+                _LOGGER.info("Redy box %s is responding again", self.host)
+            else:
+                _LOGGER.error("Redy box %s is not responding", self.host)
+            for health_callback in self._health_listeners:
+                health_callback()
+
+        for update_callback in self._listeners:
+            update_callback()
+
+
+class EdpRedyLocalWriteFilter:
+    """Decide which power readings are worth writing to the state.
+
+    A reading is written when it moved from the last written one by more
+    than both the absolute (W) and the relative deadband, and at least
+    min_interval seconds passed since the last write. Whatever the value,
+    a write is forced every heartbeat seconds (0 disables it).
+    """
+
+    __slots__ = ('absolute', 'relative', 'min_interval', 'heartbeat')
+
+    def __init__(self, absolute=0.0, relative=0.0, min_interval=0.0,
+                 heartbeat=0.0):
+        """Init the filter, relative is a fraction of the written value."""
+        self.absolute = absolute
+        self.relative = relative
+        self.min_interval = min_interval
+        self.heartbeat = heartbeat
+
+    def should_write(self, written, value, elapsed):
+        """Return True if value should replace the written one."""
+        if self.heartbeat and elapsed >= self.heartbeat:
+            return True
+        if elapsed < self.min_interval:
+            return False
+        if written == value:
+            return False
+        if not isinstance(written, float) or not isinstance(value, float):
+            # from or to unknown
+            return True
+
+        change = abs(value - written)
+        return change > self.absolute and \
+            change > self.relative * abs(written)
+
+
+class EdpRedyLocalSensor(Entity):
+    """Representation of a field of a node, the power by default."""
 
-        # create new sensor
-        sensor = EdpRedyLocalSensor(sensor_id, name, power, last_communication)
-        sensors[sensor_id] = sensor
-        new_sensors_list.append(sensor)
-
-    def parse_nodes(json_nodes):
-        for node in json_nodes:
-            if "ID" not in node:
-                continue
-            if "NAME" not in node:
-                continue
-            if "EMETER:POWER_APLUS" not in node:
-                continue
-
-            node_id = node["ID"]
-            node_name = node["NAME"]
-            node_power = node["EMETER:POWER_APLUS"]
-            load_sensor(node_id, node_name, node_power, None)
-
-    def parse_type(json, type_tag):
-        if type_tag not in json:
+    def __init__(self, node_id, name, field, value, last_communication,
+                 write_filter=None, box=None):
+        """Set up sensor and add update callback to get data from websocket."""
+        self._id = node_id
+        self._field = field
+        self._box = box
+        name_format, self._unit, self._icon = FIELD_SENSORS[field]
+        self._name = name_format.format(name)
+        self._value = value if value is not None else STATE_UNKNOWN
+        self._last_comm = last_communication
+        self._write_filter = write_filter or EdpRedyLocalWriteFilter()
+        self._written_at = time.monotonic()
+
+    def update_data(self, value, last_communication):
+        """Update the sensor's state if the change is significant."""
+        if value is None:
+            value = STATE_UNKNOWN
+        now = time.monotonic()
+        if not self._write_filter.should_write(
+                self._value, value, now - self._written_at):
             return
 
-        for device in json[type_tag]:
-            if "NODES" not in device:
-                continue
-            parse_nodes(device["NODES"])
+        self._value = value
+        self._last_comm = last_communication
+        self._written_at = now
+        self.async_schedule_update_ha_state()
 
-    def parse_json(json):
-        parse_type(json, "REDYMETER")
-        parse_type(json, "ZBENDPOINT")
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._value
 
-        if "EDPBOX" in json:
-            edp_box_json = json["EDPBOX"]
-            if len(edp_box_json) > 0:
-                edpbox_data = edp_box_json[0]
-                edpbox_id = edpbox_data["SMARTMETER_ID"]
-                edpbox_power = edpbox_data["EMETER:POWER_APLUS"]
-                edpbox_last_comm = edpbox_data["LAST_COMMUNICATION"]
-                load_sensor(edpbox_id, "Smart Meter", edpbox_power, edpbox_last_comm)
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
 
-    @asyncio.coroutine
-    def async_update():
-        """Fetch data from the redy box and update sensors."""
+    @property
+    def unique_id(self):
+        """Return a unique identifier for this sensor."""
+        if self._field == FIELD_POWER:
+            return self._id
+        return '{0}_{1}'.format(self._id, self._field)
 
-        try:
-            # get the data from the box
-            session = async_get_clientsession(hass)
-            with async_timeout.timeout(DEFAULT_TIMEOUT, loop=hass.loop):
-                resp = yield from session.get(url)
+    @property
+    def available(self):
+        """Return True if the box is responding."""
+        return self._box is None or self._box.available
 
-        except (asyncio.TimeoutError, aiohttp.ClientError):
-            _LOGGER.error("Error while accessing: %s", url)
-            return
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend."""
+        return self._icon
 
-        if resp.status != 200:
-            _LOGGER.error("%s not available", url)
-            return
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement of this sensor."""
+        return self._unit
 
-        data_html = yield from resp.text()
+    @property
+    def should_poll(self):
+        """No polling needed."""
+        return False
 
-        try:
-            html_parser = RedyHTMLParser()
-            html_parser.feed(data_html)
-            html_parser.close()
-            html_json = html_parser.json()
-            j = json.loads(html_json)
+    @property
+    def device_state_attributes(self):
+        """Return the state attributes of the sensor."""
+        if self._last_comm:
+            attr = {
+                ATTR_LAST_COMMUNICATION: self._last_comm,
+            }
+            return attr
+        return None
 
-            new_sensors_list.clear()
-            parse_json(j)
-            if len(new_sensors_list) > 0:
-                async_add_entities(new_sensors_list)
 
-        except Exception as error:
-            _LOGGER.error("Failed to load data from redy box: %s", error)
+class EnergyIntegrator:
+    """Energy (kWh) integrated from power samples with the trapezoidal rule.
 
-    @asyncio.coroutine
-    def async_update_and_sched(time):
-        yield from async_update()
-        # schedule next update
-        async_track_point_in_time(hass, async_update_and_sched,
-                                  time + timedelta(
-                                      seconds=config[CONF_UPDATE_INTERVAL]))
+    Intervals longer than max_gap (MAX_INTEGRATION_GAP by default),
+    intervals ending in an unknown power and timestamps going backwards
+    (e.g. a clock reset) are not integrated: integration restarts from the
+    next sample.
+    """
 
-    @asyncio.coroutine
-    def start_component(event):
-        _LOGGER.debug("Starting updates")
-        yield from async_update_and_sched(dt_util.utcnow())
+    __slots__ = ('total', 'last_time', 'last_power')
 
-    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_START, start_component)
+    def __init__(self, total=0.0, last_time=None, last_power=None):
+        """Init the integrator, times are unix timestamps."""
+        self.total = total
+        self.last_time = last_time
+        self.last_power = last_power
 
+    def add(self, time, power, max_gap=MAX_INTEGRATION_GAP):
+        """Add a power sample (W), return True if the total changed."""
+        if power is None:
+            self.last_time = None
+            return False
 
-class EdpRedyLocalSensor(Entity):
-    """Representation of a sensor."""
+        power = max(power, 0.0)
+        last_time, last_power = self.last_time, self.last_power
+        self.last_time = time
+        self.last_power = power
+        if last_time is None or not \
+                0 < time - last_time <= max_gap:
+            return False
 
-    def __init__(self, node_id, name, power, last_communication):
-        """Set up sensor and add update callback to get data from websocket."""
-        self._id = node_id
-        self._name = 'Power {0}'.format(name)
-        self._power = float(power)*1000 if power else STATE_UNKNOWN
-        self._last_comm = last_communication
+        self.total += (last_power + power) / 2 * (time - last_time) / 3600000
+        return True
 
-    def update_data(self, power, last_communication):
-        """Update the sensor's state."""
-        self._power = float(power)*1000 if power else STATE_UNKNOWN
-        self._last_comm = last_communication
-        self.async_schedule_update_ha_state()
+    def as_list(self):
+        """Return the state in compact form, for storage."""
+        return [self.total, self.last_time, self.last_power]
+
+
+class EdpRedyLocalEnergySensor(Entity):
+    """Representation of the energy consumed by a node."""
+
+    def __init__(self, node_id, name, integrator, box=None):
+        """Set up the sensor."""
+        self._id = node_id
+        self._name = 'Energy {0}'.format(name)
+        self._integrator = integrator
+        self._box = box
+        self._energy = round(integrator.total, 3)
+
+    def update_data(self):
+        """Update the sensor's state if the total changed."""
+        energy = round(self._integrator.total, 3)
+        if energy != self._energy:
+            self._energy = energy
+            self.async_schedule_update_ha_state()
 
     @property
     def state(self):
         """Return the state of the sensor."""
-        return self._power
+        return self._energy
 
     @property
     def name(self):
@@ -184,22 +637,76 @@ class EdpRedyLocalSensor(Entity):
     @property
     def unique_id(self):
         """Return a unique identifier for this sensor."""
-        return self._id
+        return '{0}_energy'.format(self._id)
+
+    @property
+    def available(self):
+        """Return True if the box is responding."""
+        return self._box is None or self._box.available
 
     @property
     def icon(self):
         """Return the icon to use in the frontend."""
-        return "mdi:flash"
+        return "mdi:counter"
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement of this sensor."""
+        return 'kWh'
+
+    @property
+    def should_poll(self):
+        """No polling needed."""
+        return False
+
 
-    # @property
-    # def icon(self):
-    #     """Return the icon to use in the frontend."""
-    #     return self._sensor.sensor_icon
+class EdpRedyLocalSampleRateSensor(Entity):
+    """Diagnostic sensor with the sample rate achieved polling a box."""
+
+    def __init__(self, box):
+        """Set up the sensor."""
+        self._box = box
+        self._name = 'Redy box {0} sample rate'.format(box.host)
+        self._rate = STATE_UNKNOWN
+
+    async def async_added_to_hass(self):
+        """Follow the box's requests."""
+        self._box.async_add_listener(self._update_data)
+        self._box.async_add_health_listener(
+            self.async_schedule_update_ha_state)
+
+    @callback
+    def _update_data(self):
+        rate = self._box.sample_rate
+        rate = round(rate, 2) if rate is not None else STATE_UNKNOWN
+        if rate != self._rate:
+            self._rate = rate
+            self.async_schedule_update_ha_state()
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._rate
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def unique_id(self):
+        """Return a unique identifier for this sensor."""
+        return '{0}_{1}_sample_rate'.format(DOMAIN, slugify(self._box.host))
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend."""
+        return "mdi:speedometer"
 
     @property
     def unit_of_measurement(self):
         """Return the unit of measurement of this sensor."""
-        return 'W'
+        return 'Hz'
 
     @property
     def should_poll(self):
@@ -209,9 +716,14 @@ class EdpRedyLocalSensor(Entity):
     @property
     def device_state_attributes(self):
         """Return the state attributes of the sensor."""
-        if self._last_comm:
-            attr = {
-                ATTR_LAST_COMMUNICATION: self._last_comm,
-            }
-            return attr
-        return None
+        box = self._box
+        last_duration = box.last_duration
+        return {
+            ATTR_TARGET_RATE: round(1 / box.interval, 2),
+            ATTR_SKIPPED_TICKS: box.skipped_ticks,
+            ATTR_MISSED_TICKS: box.missed_ticks,
+            ATTR_FAILED_REQUESTS: box.failed_requests,
+            ATTR_RESPONDING: box.available,
+            ATTR_LAST_DURATION: round(last_duration * 1000)
+            if last_duration is not None else None,
+        }
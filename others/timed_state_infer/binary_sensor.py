@@ -2,8 +2,9 @@
 # Infers its state from the current state and duration of other sensors.
 # """
 import asyncio
+import itertools
 import logging
-from datetime import timedelta
+from heapq import heapify, heappop, heappush
 import voluptuous as vol
 
 from homeassistant.components.binary_sensor import BinarySensorDevice
@@ -11,9 +12,7 @@ from homeassistant.const import CONF_ENTITY_ID, STATE_UNKNOWN, CONF_NAME
 import homeassistant.helpers.config_validation as cv
 from homeassistant.core import callback
 from homeassistant.helpers.config_validation import PLATFORM_SCHEMA
-from homeassistant.helpers.event import async_track_state_change,\
-    async_track_point_in_time
-from homeassistant.util import dt as dt_util
+from homeassistant.helpers.event import async_track_state_change
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -22,6 +21,9 @@ CONF_TIME_OFF = 'seconds_off'
 CONF_VALUE_ON = 'value_on'
 CONF_VALUE_OFF = 'value_off'
 DEFAULT_NAME = "Timed State Infer Binary Sensor"
+DOMAIN = 'timed_state_infer'
+# cancelled deadlines are dropped from the queue once they are the majority
+COMPACT_MIN_CANCELLED = 64
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
@@ -35,7 +37,12 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
 
 @asyncio.coroutine
 def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
-    async_add_devices([TimedStateInferBinarySensor(hass, config[CONF_NAME],
+    # one engine for the sensors of all platforms
+    engine = hass.data.get(DOMAIN)
+    if engine is None:
+        engine = hass.data[DOMAIN] = TimedStateInferEngine(hass)
+
+    async_add_devices([TimedStateInferBinarySensor(engine, config[CONF_NAME],
                                                    config[CONF_ENTITY_ID],
                                                    config[CONF_TIME_ON],
                                                    config[CONF_TIME_OFF],
@@ -43,21 +50,163 @@ def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
                                                    config[CONF_VALUE_OFF])])
 
 
+def _parse_state(state):
+    """Return the observed state as a number, None if unusable."""
+    if state == STATE_UNKNOWN:
+        return None
+
+    try:
+        return float(state)
+    except ValueError:
+        _LOGGER.warning("Value cannot be processed as a number: %s", state)
+        return None
+
+
+class TimedStateInferEngine:
+    """Evaluate the sensors' rules, grouped by observed entity.
+
+    Each observed entity has a single state listener, its new state is
+    parsed once and handed to all the rules on it. The pending deadlines of
+    all the sensors live in one heap, with a single loop timer armed for
+    the earliest. Cancelled deadlines are marked and left in place, except
+    at the top of the heap where they are dropped at once so the timer
+    moves to the next live deadline. Once the marked ones are the majority,
+    past COMPACT_MIN_CANCELLED, the heap is rebuilt without them.
+    """
+
+    def __init__(self, hass):
+        """Init the engine."""
+        self._hass = hass
+        # observed entity id -> sensors
+        self._rules = {}
+        self._unsub_listeners = {}
+        # heap of [time, sequence, sensor], sensor is None once cancelled
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._cancelled = 0
+        self._timer = None
+        self._timer_time = None
+
+    @callback
+    def async_add_rule(self, entity_id, sensor):
+        """Evaluate the rule of sensor on the states of entity_id."""
+        rules = self._rules.get(entity_id)
+        if rules is None:
+            rules = self._rules[entity_id] = []
+            self._unsub_listeners[entity_id] = async_track_state_change(
+                self._hass, entity_id, self._async_state_changed)
+        rules.append(sensor)
+
+        state = self._hass.states.get(entity_id)
+        if state is not None:
+            value = _parse_state(state.state)
+            if value is not None:
+                sensor.update_value(value)
+
+    @callback
+    def async_remove_rule(self, entity_id, sensor):
+        """Stop evaluating the rule of sensor."""
+        self.async_cancel(sensor)
+        rules = self._rules[entity_id]
+        rules.remove(sensor)
+        if not rules:
+            del self._rules[entity_id]
+            self._unsub_listeners.pop(entity_id)()
+
+    @callback
+    def _async_state_changed(self, entity_id, old_state, new_state):
+        value = None if new_state is None else _parse_state(new_state.state)
+        for sensor in self._rules.get(entity_id, ()):
+            if value is None:
+                # the value the deadline was counting on is gone
+                self.async_cancel(sensor)
+            else:
+                sensor.update_value(value)
+
+    @callback
+    def async_schedule(self, sensor, delay):
+        """Call sensor.async_pending_expired in delay seconds.
+
+        Replaces the pending deadline of the sensor, if any.
+        """
+        self.async_cancel(sensor)
+        when = self._hass.loop.time() + delay
+        entry = [when, next(self._sequence), sensor]
+        sensor.deadline = entry
+        heappush(self._deadlines, entry)
+        if self._timer_time is None or when < self._timer_time:
+            self._arm()
+
+    @callback
+    def async_cancel(self, sensor):
+        """Cancel the pending deadline of the sensor, if any."""
+        entry = sensor.deadline
+        if entry is None:
+            return
+
+        sensor.deadline = None
+        entry[2] = None
+        self._cancelled += 1
+        deadlines = self._deadlines
+        if entry is deadlines[0]:
+            # no wakeup for a cancelled deadline
+            self._drop_cancelled()
+            self._arm()
+        elif self._cancelled > COMPACT_MIN_CANCELLED and \
+                self._cancelled * 2 > len(deadlines):
+            self._deadlines = [entry for entry in deadlines
+                               if entry[2] is not None]
+            heapify(self._deadlines)
+            self._cancelled = 0
+
+    def _drop_cancelled(self):
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][2] is None:
+            heappop(deadlines)
+            self._cancelled -= 1
+
+    def _arm(self):
+        """Arm the timer for the earliest deadline."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = self._timer_time = None
+        if self._deadlines:
+            self._timer_time = self._deadlines[0][0]
+            self._timer = self._hass.loop.call_at(self._timer_time,
+                                                  self._async_expire)
+
+    @callback
+    def _async_expire(self):
+        self._timer = self._timer_time = None
+        now = self._hass.loop.time()
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            sensor = heappop(deadlines)[2]
+            if sensor is None:
+                self._cancelled -= 1
+                continue
+            sensor.deadline = None
+            sensor.async_pending_expired()
+
+        self._drop_cancelled()
+        self._arm()
+
+
 class TimedStateInferBinarySensor(BinarySensorDevice):
     """Representation of a sensor."""
 
-    def __init__(self, hass, name, observed_entity_id, time_on, time_off,
+    def __init__(self, engine, name, observed_entity_id, time_on, time_off,
                  value_on, value_off):
-        self._hass = hass
+        self._engine = engine
         self._name = name
         self._observed_entity_id = observed_entity_id
-        self._time_on = timedelta(seconds=time_on)
-        self._time_off = timedelta(seconds=time_off)
+        self._time_on = time_on
+        self._time_off = time_off
         self._value_on = value_on
         self._value_off = value_off
         self._is_on = False
-        self._pending = False
-        self._pending_since = None
+        # the deadline of the pending state change in the engine's queue
+        self.deadline = None
 
     @property
     def name(self):
@@ -77,65 +226,36 @@ class TimedStateInferBinarySensor(BinarySensorDevice):
     @asyncio.coroutine
     def async_added_to_hass(self):
         """Call when entity about to be added."""
-
-        @callback
-        def async_sensor_state_listener(entity, old_state, new_state):
-            """Handle sensor state changes."""
-            self.update_state(new_state.state)
-
-        async_track_state_change(self._hass, self._observed_entity_id,
-                                 async_sensor_state_listener)
-
-        # update the sensor when added to hass
-        yield from self.async_pending_expired(dt_util.utcnow())
+        self._engine.async_add_rule(self._observed_entity_id, self)
 
     @asyncio.coroutine
-    def async_pending_expired(self, time):
-        device_state = self.hass.states.get(self._observed_entity_id)
-        if device_state is None:
-            return
+    def async_will_remove_from_hass(self):
+        """Stop following the observed entity."""
+        self._engine.async_remove_rule(self._observed_entity_id, self)
 
-        self.update_state(device_state.state)
+    @callback
+    def async_pending_expired(self):
+        """Flip the state, the value stayed past the threshold long enough."""
+        self._is_on = not self._is_on
+        self.async_schedule_update_ha_state()
 
-    def update_state(self, observed_entity_state):
-        if observed_entity_state == STATE_UNKNOWN:
-            return
-
-        try:
-            obs_value = float(observed_entity_state)
-        except ValueError:
-            _LOGGER.warning("Value cannot be processed as a number: %s",
-                            observed_entity_state)
-            return
-
-        """If we are already in the correct state, no need to do anything"""
+    @callback
+    def update_value(self, obs_value):
+        """Evaluate the rule on a new value of the observed entity."""
+        # if we are already in the correct state, no need to do anything
         if self._is_on:
             if obs_value > self._value_off:
-                self._pending = False
+                self._engine.async_cancel(self)
                 return
         else:
             if obs_value < self._value_on:
-                self._pending = False
+                self._engine.async_cancel(self)
                 return
 
-        if self._pending:
-            time_pending = dt_util.utcnow() - self._pending_since
-            if self._is_on:
-                time_remaining = self._time_off - time_pending
-            else:
-                time_remaining = self._time_on - time_pending
-
-            if time_remaining.total_seconds() <= 0:
-                self._is_on = not self._is_on
-                self._pending = False
-                self.schedule_update_ha_state()
-        else:
-            # enter pending mode (start counting time to change state)
-            self._pending_since = dt_util.utcnow()
-            self._pending = True
-
-            time_to_expire = dt_util.utcnow() + (
-                self._time_off if self._is_on else self._time_on)
+        if self.deadline is not None:
+            # the engine flips the state at the deadline
+            return
 
-            async_track_point_in_time(self._hass, self.async_pending_expired,
-                                      time_to_expire)
+        # enter pending mode (start counting time to change state)
+        self._engine.async_schedule(
+            self, self._time_off if self._is_on else self._time_on)